@@ -7,18 +7,29 @@ GPX 読み書きユーティリティ
 """
 
 from __future__ import annotations
+import math
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import List, Dict, Any
-import gpxpy
-import gpxpy.gpx
+from typing import List, TypedDict
+import ciso8601
+import numpy as np
+from lxml import etree
 
 # タイムゾーン定義
 UTC = timezone.utc
-JST = timezone(timedelta(hours=9), 'JST')
+_JST_OFFSET = timedelta(hours=9)
+JST = timezone(_JST_OFFSET, 'JST')
 
-# ポイントデータの型エイリアス
-Point = Dict[str, Any]  # {"lat":float, "lon":float, "ele":float, "time":datetime|None}
+# GPX 1.1 の名前空間
+GPX_NS = "http://www.topografix.com/GPX/1/1"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+# ポイントデータの型 (実体は通常の dict。キーと値の型を明示するためのもの)
+class Point(TypedDict):
+    lat: float
+    lon: float
+    ele: float              # 高度 (なければ NaN)
+    time: datetime | None   # 時刻 (JST)
 
 def to_jst(t: datetime | None) -> datetime | None:
     """
@@ -27,12 +38,29 @@ def to_jst(t: datetime | None) -> datetime | None:
     """
     if t is None:
         return None
-    # タイムゾーン情報がない場合、UTCとみなす
+    # タイムゾーン情報がない場合、UTCとみなして +9h を直接足す (replace + astimezone の2段階を省く)
     if t.tzinfo is None:
-        t = t.replace(tzinfo=UTC)
-    # JSTに変換
+        return (t + _JST_OFFSET).replace(tzinfo=JST)
+    # タイムゾーン付き (ciso8601 の "Z" は timezone.utc) は C 実装の astimezone がいちばん速い
     return t.astimezone(JST)
 
+def _parse_time(text: str) -> datetime | None:
+    """
+    <time> の文字列を JST の datetime に変換する。前後の空白・改行は取り除く。
+    ciso8601 で解析できない表記は datetime.fromisoformat で読み直し、それでも読めなければ None (時刻なし) とする。
+    """
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        return to_jst(ciso8601.parse_datetime(text))
+    except ValueError:
+        pass
+    try:
+        return to_jst(datetime.fromisoformat(text))
+    except ValueError:
+        return None
+
 def load_gpx(path: str | Path) -> tuple[List[Point], str]:
     """
     GPXファイルを読み込み、ポイントリストとトラック名を返す。
@@ -44,74 +72,180 @@ def load_gpx(path: str | Path) -> tuple[List[Point], str]:
         tuple[List[Point], str]: ポイントデータのリストとトラック名。
                                   ポイントデータは緯度(lat), 経度(lon), 高度(ele), 時刻(time in JST) を含む辞書。
     """
+    pts: List[Point] = []
+    # ループ内で毎回属性を引かないよう、よく使うメソッドをローカル変数に束縛しておく
+    append_point = pts.append
+    parse_time = _parse_time
+    gpx_name: str | None = None  # <metadata><name> (GPX 1.1) / <gpx><name> (GPX 1.0)
+    trk_name: str | None = None  # 最初に見つかった <trk><name>
     try:
-        with open(path, encoding="utf-8") as fp:
-            gpx = gpxpy.parse(fp)
-    except Exception as e:
-        raise IOError(f"GPXファイルの読み込みに失敗しました: {e}") from e
+        with open(path, "rb") as fp:
+            # DOM を構築せず、trkpt と name の終了タグだけを順に処理する
+            for _, elem in etree.iterparse(fp, events=("end",), tag=("{*}trkpt", "{*}name")):
+                if etree.QName(elem).localname == "name":
+                    # 親要素によってGPX全体の名前かトラック名かを判別 (wpt/trkpt等の名前は無視)
+                    parent = etree.QName(elem.getparent()).localname
+                    text = (elem.text or "").strip() or None
+                    if parent in ("metadata", "gpx") and gpx_name is None:
+                        gpx_name = text
+                    elif parent == "trk" and trk_name is None:
+                        trk_name = text
+                    continue
 
-    pts: List[Point] = []
-    # GPXファイル内の全トラック、全セグメントを走査
-    for trk in gpx.tracks:
-        for seg in trk.segments:
-            for p in seg.points:
                 # 各ポイントの情報を抽出し、リストに追加
-                pts.append({
-                    "lat": p.latitude,
-                    "lon": p.longitude,
-                    "ele": p.elevation or 0.0,  # 高度がない場合は0.0
-                    "time": to_jst(p.time),    # 時刻をJSTに変換
+                ele = elem.findtext("{*}ele")
+                time = elem.findtext("{*}time")
+                append_point({
+                    "lat": float(elem.get("lat")),
+                    "lon": float(elem.get("lon")),
+                    # 高度がない場合は NaN (0m と区別する。0.0 での穴埋めは使う側で配列演算で行う)
+                    "ele": float(ele) if ele else math.nan,
+                    # 時刻はISO 8601形式なので C 実装の ciso8601 で解析し、JSTに変換 (読めない時刻はその点だけ None)
+                    "time": parse_time(time) if time else None,
                 })
 
+                # 処理済みの要素を破棄してメモリ使用量を抑える
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+    except Exception as e:
+        raise IOError(f"GPXファイルの読み込みに失敗しました: {e}") from e
+
     # トラック名を取得。なければファイル名を代用
-    name = gpx.name or (gpx.tracks[0].name if gpx.tracks and gpx.tracks[0].name else Path(path).stem)
+    name = gpx_name or trk_name or Path(path).stem
     return pts, name
 
+def _float_or_nan(value) -> float:
+    """数値ならそのまま、None や不正値なら NaN を返す"""
+    return value if isinstance(value, (int, float)) else math.nan
+
+def points_to_arrays(points: List[Point]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    ポイントリストを項目ごとの配列 (Struct of Arrays) に変換する。
+    辞書の参照は1回の走査にまとめ、以降の計算は配列で行えるようにする。
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+            緯度・経度・標高 (float64, 無効値は NaN) と時刻 (object, JSTのdatetime または None) の配列。
+    """
+    n = len(points)
+    try:
+        # load_gpx で読んだポイントは lat/lon/ele がそろった数値 (なければ NaN) なので、一度にまとめて変換する
+        coords = np.array([(p["lat"], p["lon"], p["ele"]) for p in points], dtype=np.float64).reshape(n, 3)
+        lat, lon, ele = coords[:, 0].copy(), coords[:, 1].copy(), coords[:, 2].copy()
+    except (KeyError, TypeError, ValueError):
+        # 欠けた項目や数値でない値を含む場合は、値ごとに確認して NaN で埋める
+        lat = np.fromiter((_float_or_nan(p.get("lat")) for p in points), dtype=np.float64, count=n)
+        lon = np.fromiter((_float_or_nan(p.get("lon")) for p in points), dtype=np.float64, count=n)
+        ele = np.fromiter((_float_or_nan(p.get("ele")) for p in points), dtype=np.float64, count=n)
+    time = np.empty(n, dtype=object)
+    time[:] = [p.get("time") for p in points]
+    return lat, lon, ele, time
+
+def rdp_indices(lats: np.ndarray, lons: np.ndarray, epsilon_m: float = 2.0) -> np.ndarray:
+    """
+    Ramer–Douglas–Peucker 法で軌跡を間引き、残すポイントのインデックス (昇順) を返す。
+    直線からのずれが epsilon_m (m) 以下の中間点を省く。座標が無効 (NaN) なポイントは含めない。
+    再帰の代わりに区間のスタックを使い、各区間の距離計算は配列演算で行う。
+    """
+    valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+    if len(valid) < 3:
+        return valid
+    # トラックの範囲は狭いので、先頭を原点とする平面 (正距円筒図法, m) で距離を求める
+    lat_r = np.deg2rad(lats[valid])
+    lon_r = np.deg2rad(lons[valid])
+    radius = 6378137.0 # WGS84 赤道半径 (m)
+    x = (lon_r - lon_r[0]) * (radius * math.cos(lat_r[0]))
+    y = (lat_r - lat_r[0]) * radius
+
+    keep = np.zeros(len(valid), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(valid) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = math.hypot(dx, dy)
+        if length > 0:
+            dist = np.abs(dx * py - dy * px) / length # 始点・終点を結ぶ直線からの距離
+        else:
+            dist = np.hypot(px, py) # 始点と終点が同じ位置なら始点からの距離
+        k = int(np.argmax(dist))
+        if dist[k] > epsilon_m:
+            mid = start + 1 + k
+            keep[mid] = True
+            stack.append((start, mid))
+            stack.append((mid, end))
+    return valid[keep]
+
+def _format_utc_times(times: List[datetime | None]) -> List[str | None]:
+    """
+    時刻リストをまとめてUTCのISO 8601文字列 (末尾 Z) に変換する。
+    タイムゾーン情報がない場合はJSTとして扱う（load_gpxでJSTに変換しているため）。
+    """
+    # 各時刻をUNIX時間 (UTC基準) の配列にし、datetime64 で一括して文字列化する
+    # (datetime ごとの astimezone/isoformat 呼び出しを避ける)
+    epochs = np.array([
+        math.nan if t is None else (t if t.tzinfo is not None else t.replace(tzinfo=JST)).timestamp()
+        for t in times
+    ], dtype=np.float64)
+    has_time = np.isfinite(epochs)
+    utc = np.round(np.where(has_time, epochs, 0.0) * 1e6).astype(np.int64).astype("datetime64[us]")
+    whole = utc.astype("datetime64[s]")
+    iso = np.datetime_as_string(whole, unit="s")
+    # 秒未満の端数がある時刻のみマイクロ秒まで出力する
+    fractional = utc != whole
+    if fractional.any():
+        iso = np.where(fractional, np.datetime_as_string(utc, unit="us"), iso)
+    return [f"{s}Z" if ok else None for s, ok in zip(iso.tolist(), has_time.tolist())]
+
 def save_gpx(points: List[Point], dst: str | Path, trk_name: str) -> None:
     """
     ポイントリストをGPXファイルとして保存する。
+    GPXのオブジェクトツリーは作らず、XMLを要素ごとに直接ファイルへ書き出す。
 
     Args:
         points (List[Point]): 保存するポイントデータのリスト。
         dst (str | Path): 保存先のファイルパス。
         trk_name (str): GPXファイルに記録するトラック名。
     """
-    # 新しいGPXオブジェクトを作成
-    gpx = gpxpy.gpx.GPX()
-    gpx.name = trk_name # GPX全体の名前
-
-    # GPXトラックを作成
-    trk = gpxpy.gpx.GPXTrack(name=trk_name)
-    gpx.tracks.append(trk)
-
-    # GPXセグメントを作成
-    seg = gpxpy.gpx.GPXTrackSegment()
-    trk.segments.append(seg)
-
-    # ポイントデータをGPX形式に変換して追加
-    for p in points:
-        t = p.get("time")
-        utc_time = None
-        if t is not None:
-            # タイムゾーン情報がない場合はJSTとみなす（load_gpxでJSTに変換しているため）
-            if t.tzinfo is None:
-                t = JST.localize(t)
-            # UTCに変換して保存
-            utc_time = t.astimezone(UTC)
-
-        seg.points.append(
-            gpxpy.gpx.GPXTrackPoint(
-                latitude=p["lat"],
-                longitude=p["lon"],
-                elevation=p["ele"],
-                time=utc_time  # 時刻はUTCで保存
-            )
-        )
+    # 時刻は書き出し前にまとめてUTCの文字列に変換しておく
+    utc_times = _format_utc_times([p.get("time") for p in points])
 
     try:
-        # GPXデータをXML形式でファイルに書き込み
-        with open(dst, "w", encoding="utf-8") as fp:
-            # prettyprint=True で整形されたXMLを出力（デバッグしやすい）
-            fp.write(gpx.to_xml(prettyprint=True))
+        with open(dst, "wb") as fp, etree.xmlfile(fp, encoding="utf-8") as xf:
+            xf.write_declaration()
+            with xf.element(
+                "gpx",
+                attrib={f"{{{XSI_NS}}}schemaLocation": f"{GPX_NS} {GPX_NS}/gpx.xsd"},
+                nsmap={None: GPX_NS, "xsi": XSI_NS},
+                version="1.1",
+                creator="gpxhandle",
+            ):
+                # GPX全体の名前
+                metadata = etree.Element("metadata")
+                etree.SubElement(metadata, "name").text = trk_name
+                xf.write("\n", metadata, pretty_print=True)
+
+                with xf.element("trk"):
+                    name = etree.Element("name")
+                    name.text = trk_name
+                    xf.write("\n", name, "\n")
+
+                    with xf.element("trkseg"):
+                        xf.write("\n")
+                        # ポイントごとに trkpt 要素を作って書き出す（時刻はUTC）
+                        for p, utc_time in zip(points, utc_times):
+                            trkpt = etree.Element("trkpt", lat=repr(p["lat"]), lon=repr(p["lon"]))
+                            ele = p.get("ele")
+                            if ele is not None and math.isfinite(ele): # 高度なし(NaN)は ele 要素を出力しない
+                                etree.SubElement(trkpt, "ele").text = repr(ele)
+                            if utc_time is not None:
+                                etree.SubElement(trkpt, "time").text = utc_time
+                            xf.write(trkpt, pretty_print=True)
+                    xf.write("\n")
+                xf.write("\n")
     except Exception as e:
         raise IOError(f"GPXファイルの保存に失敗しました: {e}") from e
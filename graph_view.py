@@ -5,24 +5,35 @@ gpxhandle/graph_view.py
 """
 
 import flet as ft
-from typing import List, Dict, Optional
-import gpxpy.gpx
+from typing import Callable, List, Dict, Optional
 import math
 from datetime import timedelta, datetime
 import numpy as np
-import traceback
+import logging
+from gpx_handler import points_to_arrays
+
+logger = logging.getLogger(__name__)
+
+# グラフの枠線・グリッド線の色 (インスタンスごとに作らず共有する)
+_GRID_COLOR = ft.Colors.with_opacity(0.2, ft.Colors.ON_SURFACE)
+# 統計情報の背景色
+_STATS_BGCOLOR = ft.Colors.with_opacity(0.7, ft.Colors.WHITE)
 
 class ElevationGraph(ft.Container):
     """標高グラフと統計情報表示コンポーネント"""
 
     SMOOTHING_WINDOW_SIZE: int = 5 # 移動平均ウィンドウサイズ (奇数推奨)
     ASCENT_THRESHOLD_METERS: float = 0.3 # 累積登り閾値 (m)
-
-    def __init__(self):
-        # --- 軸ラベル・タイトルのサイズ設定 ---
-        AXIS_LABEL_SIZE = 20  # ★ 軸の数値ラベルサイズ (小さめに)
-        AXIS_TITLE_SIZE = 9 # ★ 軸タイトルサイズ
-
+    EARTH_RADIUS_METERS: float = 6378137.0 # 地球半径 (m, WGS84 赤道半径)
+    # --- 軸ラベル・タイトルのサイズ設定 ---
+    AXIS_LABEL_SIZE: int = 20  # ★ 軸の数値ラベルサイズ (小さめに)
+    AXIS_TITLE_SIZE: int = 9 # ★ 軸タイトルサイズ
+
+    def __init__(self, on_point_hover: Optional[Callable[[int], None]] = None):
+        """on_point_hover: グラフ上のポイントにカーソルが乗ったときのコールバック (ポイントのインデックス。外れたら -1)"""
+        self.on_point_hover = on_point_hover
+        # グラフに描いた各データポイントの元のポイントのインデックス。イベントの spot_index から直接引く
+        self._chart_src_idx = np.empty(0, dtype=np.intp)
         # --- 統計情報表示用 Text ---
         self.stats_text = ft.Text(
             # value="時間: -\n距離: -\n累積登り: -", # 初期値はload_pointsで設定
@@ -31,7 +42,7 @@ class ElevationGraph(ft.Container):
         )
         stats_container = ft.Container(
             content=self.stats_text,
-            bgcolor=ft.colors.with_opacity(0.7, ft.Colors.WHITE),
+            bgcolor=_STATS_BGCOLOR,
             padding=ft.padding.all(4),
             border_radius=ft.border_radius.all(3),
             top=5, right=5, # Stack内での位置
@@ -43,24 +54,25 @@ class ElevationGraph(ft.Container):
             tooltip_bgcolor="rgba(0,0,0,0.8)",
             min_y=0, max_y=1000, # データロード時に再設定
             min_x=0, # X軸最小値
-            border=ft.border.all(2, ft.Colors.with_opacity(0.2, ft.Colors.ON_SURFACE)),
+            border=ft.border.all(2, _GRID_COLOR),
             horizontal_grid_lines=ft.ChartGridLines(
-                interval=100, color=ft.Colors.with_opacity(0.2, ft.Colors.ON_SURFACE), width=1
+                interval=100, color=_GRID_COLOR, width=1
             ),
             vertical_grid_lines=ft.ChartGridLines(
-                interval=100, color=ft.Colors.with_opacity(0.2, ft.Colors.ON_SURFACE), width=1
+                interval=100, color=_GRID_COLOR, width=1
             ),
             # --- ★ 軸ラベル・タイトルのサイズ調整箇所 ---
             left_axis=ft.ChartAxis(
-                labels_size=AXIS_LABEL_SIZE,
-                title=ft.Text("標高(m)", size=AXIS_TITLE_SIZE, weight=ft.FontWeight.BOLD),
+                labels_size=self.AXIS_LABEL_SIZE,
+                title=ft.Text("標高(m)", size=self.AXIS_TITLE_SIZE, weight=ft.FontWeight.BOLD),
             ),
             bottom_axis=ft.ChartAxis(
                 labels_interval=1, # X軸ラベル間隔 (データロード時に再設定)
-                labels_size=AXIS_LABEL_SIZE, # X軸数値ラベルサイズ
-                title=ft.Text("距離(km)", size=AXIS_TITLE_SIZE, weight=ft.FontWeight.BOLD),
+                labels_size=self.AXIS_LABEL_SIZE, # X軸数値ラベルサイズ
+                title=ft.Text("距離(km)", size=self.AXIS_TITLE_SIZE, weight=ft.FontWeight.BOLD),
             ),
             data_series=[],
+            on_chart_event=self._handle_chart_event,
         )
 
         # --- グラフと統計情報を重ねる ---
@@ -90,113 +102,198 @@ class ElevationGraph(ft.Container):
         # --- 内部データ ---
         self.points: List[Dict] = []
         self.distances: List[float] = [] # 累積距離 (km)
+        self._distances_arr: np.ndarray = np.empty(0) # 累積距離 (km) の配列 (昇順。距離→インデックスの二分探索用)
+        # ポイントデータを項目ごとの配列 (Struct of Arrays) として保持
+        self.lat: np.ndarray = np.empty(0)  # 緯度 (無効値は NaN)
+        self.lon: np.ndarray = np.empty(0)  # 経度 (無効値は NaN)
+        self.ele: np.ndarray = np.empty(0)  # 標高 (無効値は NaN)
+        self.time: np.ndarray = np.empty(0, dtype=object) # 時刻 (JSTのdatetime または None)
+        # 距離計算用に緯度のラジアンと cos(緯度) をトラックごとに1回だけ求めて保持する
+        # (load_points で作り直すので、リスト側の編集後も古い値は残らない)
+        self._lat_rad: np.ndarray = np.empty(0)
+        self._cos_lat: np.ndarray = np.empty(0)
         self.total_time_str = "-"
         self.total_distance_km = 0.0
         self.total_ascent_m = 0.0
 
-    def _smooth_elevations(self, elevations: List[float], window_size: int) -> List[float]:
-        """標高データリストに NumPy の convolve を使って移動平均フィルタを適用する"""
-        if window_size < 3 or not elevations or len(elevations) < window_size:
-            print("[DEBUG Graph] Smoothing skipped (too few points or small window)")
-            return elevations # 平滑化しない場合は元のリストを返す
+    def _smooth_elevations(self, elevations: np.ndarray, window_size: int) -> np.ndarray:
+        """標高配列に累積和を使った移動平均フィルタを適用する (ウィンドウサイズによらず O(N))"""
+        if window_size < 3 or len(elevations) < window_size:
+            logger.debug("Smoothing skipped (too few points or small window)")
+            return elevations # 平滑化しない場合は元の配列を返す
 
-        # NumPy 配列に変換
-        elevation_array = np.array(elevations, dtype=float) # float型を指定
+        # NumPy 配列に変換 (既に float64 の配列ならコピーしない)
+        elevation_array = np.asarray(elevations, dtype=float)
 
-        # ウィンドウ（カーネル）を作成 (要素がすべて 1/window_size)
-        window = np.ones(window_size) / window_size
+        # 累積和の差分から各ウィンドウの合計を求め、移動平均とする
+        # 先頭に0を挿入しておくと c[k+W] - c[k] が elevation_array[k:k+W] の合計になる
+        c = np.cumsum(np.insert(elevation_array, 0, 0.0))
+        window_means = (c[window_size:] - c[:-window_size]) / window_size
+
+        # ウィンドウが収まらない端点は元の値のまま残し、入力と同じ長さにする
+        half_window = window_size // 2
+        smoothed_array = elevation_array.copy()
+        smoothed_array[half_window:half_window + len(window_means)] = window_means
+
+        logger.debug("Applied NumPy smoothing with window size %d", window_size)
+        return smoothed_array
+
+    def _segment_distances(self, lon: np.ndarray) -> np.ndarray:
+        """
+        隣接ポイント間の距離(m)を Haversine で一括計算する。
+        緯度側は load_points で保持した self._lat_rad / self._cos_lat を使い、中間配列は in-place で使い回す。
+        """
+        lat_r = self._lat_rad
+        cos_lat = self._cos_lat
+        # a = sin²(Δφ/2) + cos φ1 · cos φ2 · sin²(Δλ/2)
+        a = np.diff(lat_r)
+        a *= 0.5
+        np.sin(a, out=a)
+        a *= a
+        h = np.diff(np.deg2rad(lon))
+        h *= 0.5
+        np.sin(h, out=h)
+        h *= h
+        h *= cos_lat[:-1]
+        h *= cos_lat[1:]
+        a += h
+        # 距離 = 2R · asin(√a) (丸め誤差で a が [0, 1] を外れないようにクリップ)
+        np.clip(a, 0.0, 1.0, out=a)
+        np.sqrt(a, out=a)
+        np.arcsin(a, out=a)
+        a *= 2 * self.EARTH_RADIUS_METERS
+        return a
+
+    def _compute_track_stats(self, lon: np.ndarray, ele: np.ndarray,
+                             valid: np.ndarray) -> tuple[np.ndarray, float]:
+        """
+        区間距離(m)と累積登り(m)をまとめて計算する。緯度は self._lat_rad / self._cos_lat を使う。
+        隣接する両方のポイントの座標が有効な区間のみを対象とする (無効区間の距離は0)。
+
+        Returns:
+            tuple[np.ndarray, float]: 区間距離の配列 (長さ N-1) と累積登り。
+        """
+        seg_valid = valid[:-1] & valid[1:]
+        seg_m = self._segment_distances(lon)
+        seg_m[~seg_valid] = 0.0
+
+        # 標高がNoneや不正値、または座標が無効な場合は0.0として扱い、移動平均で平滑化
+        raw_elevations = np.where(valid & np.isfinite(ele), ele, 0.0)
+        smoothed_elevations = self._smooth_elevations(raw_elevations, self.SMOOTHING_WINDOW_SIZE)
+        if len(smoothed_elevations) != len(raw_elevations):
+            logger.error("平滑化後の標高データ数が一致しません！元のデータを使用します。")
+            smoothed_elevations = raw_elevations
+
+        # 平滑化後の標高差と閾値で累積登りを計算 (有効な区間のみ)
+        ele_diffs = np.diff(smoothed_elevations)
+        climbs = seg_valid & (ele_diffs > self.ASCENT_THRESHOLD_METERS)
+        return seg_m, float(ele_diffs[climbs].sum())
 
-        try:
-            # 畳み込み演算で移動平均を計算
-            # mode='same' は出力配列が入力と同じ長さになるように調整する
-            # 境界の処理はデフォルト (zero padding) になるため、端の値は不正確になる可能性がある
-            smoothed_array = np.convolve(elevation_array, window, mode='same')
-
-            # ★ オプション: 端点の値を元の値に戻す (より自然な結果になる場合がある) ★
-            half_window = window_size // 2
-            smoothed_array[:half_window] = elevation_array[:half_window]
-            smoothed_array[-half_window:] = elevation_array[-half_window:]
-            # または smoothed_array = np.convolve(elevation_array, window, mode='valid')
-            # を使い、結果の配列長が変わることに対応する（より複雑になる）
-
-            print(f"[DEBUG Graph] Applied NumPy smoothing with window size {window_size}")
-            return smoothed_array.tolist() # 結果をリストとして返す
-
-        except Exception as e:
-            print(f"[ERROR] Error during NumPy smoothing: {e}")
-            traceback.print_exc()
-            return elevations # エラー時は元のデータを返す
- 
     def load_points(self, points: List[Dict]):
         """
         ポイントデータを読み込み、統計計算、グラフ描画を行う。
-        距離計算に gpxpy.distance_2d を使用。
+        距離計算に NumPy でベクトル化した Haversine を使用。
         累積登り計算に 移動平均(NumPy) + 閾値処理 を使用。
         """
-        print(f"[DEBUG Graph] load_points: 受信ポイント数 = {len(points)}")
+        logger.debug("load_points: 受信ポイント数 = %d", len(points))
         self.points = points # 元の辞書リストを保持
+        try:
+            # --- 1. ポイントデータを項目ごとの NumPy 配列に変換 ---
+            # 辞書の参照はここで一度だけ行い、以降の処理は配列を使う
+            # 数値でない値は NaN とし、無効な座標としてマスクする
+            self.lat, self.lon, self.ele, self.time = points_to_arrays(points)
+            self._lat_rad = np.deg2rad(self.lat)
+            self._cos_lat = np.cos(self._lat_rad)
+            valid = np.isfinite(self.lat) & np.isfinite(self.lon)
+            invalid_coord_count = len(valid) - int(np.count_nonzero(valid))
+            if invalid_coord_count:
+                # ポイントごとには出力せず件数だけをまとめて出す
+                logger.warning("無効な座標データ: %d 件 (最初の index %d)",
+                               invalid_coord_count, int(np.argmin(valid)))
+        except Exception as load_ex:
+            self._show_error(load_ex)
+            return
+        self._update_from_arrays()
+
+    def apply_delta(self, change: Dict):
+        """
+        削除・アンドゥで変わった点だけを項目ごとの配列に反映し、統計とグラフを更新する。
+        辞書リスト全体からの配列の作り直し (load_points の手順1) を省く。
+        change は {"op": "delete"|"insert", "indices": [...]} (delete は削除前の位置、insert は挿入後の位置。昇順)。
+        """
+        op = change.get("op")
+        indices = change.get("indices") or []
+        if op == "delete" and indices:
+            drop = np.asarray(indices, dtype=np.intp)
+            self.lat, self.lon, self.ele, self.time, self._lat_rad, self._cos_lat = (
+                np.delete(arr, drop) for arr in
+                (self.lat, self.lon, self.ele, self.time, self._lat_rad, self._cos_lat))
+        elif op == "insert" and indices:
+            # np.insert の位置は挿入前の配列基準なので、k 番目の挿入後位置から k を引く
+            before = np.asarray(indices, dtype=np.intp) - np.arange(len(indices))
+            lat, lon, ele, time = points_to_arrays([self.points[i] for i in indices])
+            lat_rad = np.deg2rad(lat)
+            self.lat = np.insert(self.lat, before, lat)
+            self.lon = np.insert(self.lon, before, lon)
+            self.ele = np.insert(self.ele, before, ele)
+            self.time = np.insert(self.time, before, time)
+            self._lat_rad = np.insert(self._lat_rad, before, lat_rad)
+            self._cos_lat = np.insert(self._cos_lat, before, np.cos(lat_rad))
+        if len(self.lat) != len(self.points):
+            # 想定外の変更 (件数の不一致) は辞書リストから作り直す
+            logger.warning("apply_delta: ポイント数が一致しないため再読み込みします (%d != %d)",
+                           len(self.lat), len(self.points))
+            self.load_points(self.points)
+            return
+        self._update_from_arrays()
+
+    def _show_error(self, ex: Exception):
+        """読み込み・計算中のエラー時にグラフと内部データをクリアする"""
+        logger.exception("graph_view load_points でエラーが発生しました: %s", ex)
+        self.points = []
+        self.distances = []
+        self._distances_arr = np.empty(0)
+        self._chart_src_idx = np.empty(0, dtype=np.intp)
+        self.lat = self.lon = self.ele = np.empty(0)
+        self._lat_rad = self._cos_lat = np.empty(0)
+        self.time = np.empty(0, dtype=object)
+        self.chart.data_series = []
+        self.stats_text.value = "エラーが発生しました"
+        self.info_text.value = ""
+        self.update()
+
+    def _update_from_arrays(self):
+        """項目ごとの配列 (self.lat など) から距離・累積登り・時間を計算し、統計とグラフを更新する。"""
+        points = self.points
+        lat, lon, ele = self.lat, self.lon, self.ele
         self.distances = [0.0] # 累積距離リスト(km)を初期化
         current_dist_m = 0.0   # 累積距離(m)
         total_ascent = 0.0     # 累積登り(m)
         start_time: Optional[datetime] = None
         end_time: Optional[datetime] = None
         data_points = []       # グラフのデータポイント用
-        gpx_points = []        # gpxpyオブジェクト用リスト
 
         try:
-            # --- 1. GPXデータからgpxpy.GPXTrackPointオブジェクトを生成 ---
-            # 同時に start_time と end_time も取得
-            for i, p in enumerate(points):
-                lat = p.get('lat')
-                lon = p.get('lon')
-                ele = p.get('ele')
-                time = p.get('time') # JSTのdatetimeオブジェクトのはず
-                if isinstance(lat, (int, float)) and isinstance(lon, (int, float)):
-                    # 標高がNoneや不正値の場合は0.0として扱う (または補間処理)
-                    elevation = ele if isinstance(ele, (int, float)) else 0.0
-                    gpx_p = gpxpy.gpx.GPXTrackPoint(latitude=lat, longitude=lon, elevation=elevation, time=time)
-                    gpx_points.append(gpx_p)
-                    # 有効な時刻情報を記録
-                    if time and isinstance(time, datetime):
-                        if start_time is None: start_time = time
-                        end_time = time # 最後の有効な時刻で上書き
-                else:
-                    print(f"[WARN] 無効な座標データ: index {i}")
-                    gpx_points.append(None) # 無効な座標はNoneとしておく
-
-            # --- 2. 標高データを抽出し、移動平均で平滑化 ---
-            raw_elevations = [(p.elevation or 0.0) if p else 0.0 for p in gpx_points]
-            smoothed_elevations = self._smooth_elevations(raw_elevations, self.SMOOTHING_WINDOW_SIZE)
-            if len(smoothed_elevations) != len(raw_elevations):
-                print("[ERROR] 平滑化後の標高データ数が一致しません！元のデータを使用します。")
-                smoothed_elevations = raw_elevations
-
-            # --- 3. 距離(2D)と累積登り(平滑化+閾値)を計算 ---
-            self.distances = [0.0] # 距離リスト再初期化
-            current_dist_m = 0.0
-            total_ascent = 0.0
-            for i in range(len(gpx_points) - 1):  # gpx_points の数でループ
-                p1 = gpx_points[i]
-                p2 = gpx_points[i+1]
-                dist_m = 0.0
-                # 平滑化後の標高差を計算
-                ele_diff_smoothed = smoothed_elevations[i+1] - smoothed_elevations[i]
-
-                # 隣接する両方のポイントが有効な場合のみ計算
-                if p1 and p2:
-                    # 2D距離を計算
-                    dist_m = p1.distance_2d(p2) or 0.0
-                    current_dist_m += dist_m
-                    # 平滑化後の標高差と閾値で累積登りを計算
-                    if ele_diff_smoothed > self.ASCENT_THRESHOLD_METERS:
-                        total_ascent += ele_diff_smoothed
-                # 距離リストには常に現在の累積距離を追加 (ポイント数と合わせるため)
-                self.distances.append(current_dist_m / 1000.0) # kmで追加
-
-            print(f"[DEBUG Graph] 距離(2D)計算完了: 全長 = {current_dist_m / 1000.0:.2f} km")
-            print(f"[DEBUG Graph] 累積登り計算完了 (平滑化{self.SMOOTHING_WINDOW_SIZE}点 + 閾値>{self.ASCENT_THRESHOLD_METERS}m): {total_ascent:.1f} m")
-
-            # --- 4. 歩行時間計算 ---
+            valid = np.isfinite(lat) & np.isfinite(lon)
+
+            # 同時に start_time と end_time も取得 (有効な座標のポイントのみ)
+            for time, is_valid in zip(self.time, valid.tolist()):
+                if is_valid and isinstance(time, datetime):
+                    if start_time is None: start_time = time
+                    end_time = time # 最後の有効な時刻で上書き
+
+            # --- 2. 距離(2D, Haversine)と累積登り(平滑化+閾値)を計算 ---
+            seg_m, total_ascent = self._compute_track_stats(lon, ele, valid)
+            # 距離リストはポイント数と合わせるため先頭に0を置く (kmで保持)
+            self._distances_arr = np.concatenate(([0.0], np.cumsum(seg_m) / 1000.0))
+            self.distances = self._distances_arr.tolist()
+            current_dist_m = float(seg_m.sum())
+
+            logger.debug("距離(2D)計算完了: 全長 = %.2f km", current_dist_m / 1000.0)
+            logger.debug("累積登り計算完了 (平滑化%d点 + 閾値>%sm): %.1f m",
+                         self.SMOOTHING_WINDOW_SIZE, self.ASCENT_THRESHOLD_METERS, total_ascent)
+
+            # --- 3. 歩行時間計算 ---
             total_seconds = 0
             if start_time and end_time and end_time > start_time:
                 delta: timedelta = end_time - start_time
@@ -207,31 +304,33 @@ class ElevationGraph(ft.Container):
             self.total_distance_km = current_dist_m / 1000.0
             self.total_ascent_m = total_ascent
 
-            # --- 5. 統計情報テキスト更新 ---
+            # --- 4. 統計情報テキスト更新 ---
             self.stats_text.value = f"時間: {self.total_time_str}\n" \
                                     f"距離: {self.total_distance_km:.2f} km\n" \
                                     f"累積登り: {self.total_ascent_m:.0f} m"
-            self.stats_text.update() # 統計テキストを更新
-
-            # --- 6. グラフ用データポイント生成 (元の標高を使用) ---
-            data_points = []
-            for i, p_dict in enumerate(points): # 間引かれた points でループ
-                ele = p_dict.get('ele')
-                # ★★★ distances リストとのインデックスずれがないか確認 ★★★
-                if isinstance(ele, (int, float)) and i < len(self.distances):
-                    x_val = self.distances[i]
-                    y_val = ele
-                    if not math.isnan(x_val) and not math.isinf(x_val) and \
-                       not math.isnan(y_val) and not math.isinf(y_val):
-                        data_points.append(ft.LineChartDataPoint(x=x_val, y=y_val, tooltip=...))
-                    else: print(f"[WARN] Invalid DP skipped: x={x_val}, y={y_val} at index {i}")
-                else: print(f"[WARN] DP generation skipped: index {i}, ele={ele}, dist_len={len(self.distances)}")
-
-            print(f"[DEBUG Graph] 生成されたグラフデータポイント数 = {len(data_points)}")
-            # ★★★ 最初の数件のデータポイントを出力 ★★★
-            print(f"[DEBUG Graph] First 5 data points (x, y): {[(dp.x, dp.y) for dp in data_points[:5]] if data_points else 'None'}")
-
-            # --- 7. グラフデータ系列設定 ---
+            # (UI更新は最後の self.update() でまとめて行う)
+
+            # --- 5. グラフ用データポイント生成 (元の標高を使用) ---
+            # 距離・標高がともに有限値のポイントを配列演算で抽出し、一括で生成する
+            x_vals = self._distances_arr
+            y_vals = self.ele[:len(x_vals)]
+            finite = np.isfinite(x_vals) & np.isfinite(y_vals)
+            self._chart_src_idx = np.flatnonzero(finite)
+            data_points = [
+                ft.LineChartDataPoint(x=x_val, y=y_val)
+                for x_val, y_val in zip(x_vals[finite].tolist(), y_vals[finite].tolist())
+            ]
+            skipped_count = len(finite) - len(data_points)
+            if skipped_count:
+                logger.warning("DP generation skipped: %d points (標高なし/無効値)", skipped_count)
+
+            logger.debug("生成されたグラフデータポイント数 = %d", len(data_points))
+            # ★★★ 最初の数件のデータポイントを出力 (DEBUG 時のみリストを作る) ★★★
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("First 5 data points (x, y): %s",
+                             [(dp.x, dp.y) for dp in data_points[:5]] if data_points else 'None')
+
+            # --- 6. グラフデータ系列設定 ---
             self.chart.data_series = [
                 ft.LineChartData(
                     data_points=data_points,
@@ -240,16 +339,17 @@ class ElevationGraph(ft.Container):
                     curved=False,
                 )
             ]
-            print(f"[DEBUG Graph] data_series 設定完了: {len(self.chart.data_series)} 系列, ポイント数 {len(data_points)}")
+            logger.debug("data_series 設定完了: %d 系列, ポイント数 %d", len(self.chart.data_series), len(data_points))
 
-            # --- 8. 軸範囲設定 ---
+            # --- 7. 軸範囲設定 ---
             # Y軸(標高)
             min_ele_valid, max_ele_valid = None, None
             if points:
-                elevations = [p.get('ele') for p in points if isinstance(p.get('ele'), (int, float))]
-                if elevations:
-                    min_ele_valid = min(elevations)
-                    max_ele_valid = max(elevations)
+                # 標高配列から有限値だけを取り出し、最小・最大を配列演算で求める
+                finite_ele = self.ele[np.isfinite(self.ele)]
+                if finite_ele.size:
+                    min_ele_valid = float(finite_ele.min())
+                    max_ele_valid = float(finite_ele.max())
                     ele_range = max_ele_valid - min_ele_valid
                     padding = ele_range * 0.1 if ele_range > 10 else 5 # 最小パディング
                     self.chart.min_y = math.floor((min_ele_valid - padding) / 10) * 10
@@ -284,39 +384,56 @@ class ElevationGraph(ft.Container):
                     y_interval = min(y_intervals, key=lambda y: abs(y - ideal_y_interval))
                     self.chart.horizontal_grid_lines.interval = max(1, y_interval) # 最小1m
                 else: self.chart.horizontal_grid_lines.interval = 10
-            print(f"[DEBUG Graph] Axes set: Y({self.chart.min_y:.0f}-{self.chart.max_y:.0f}, grid={self.chart.horizontal_grid_lines.interval if self.chart.horizontal_grid_lines else 'N/A'}), X({self.chart.min_x}-{self.chart.max_x:.1f}, label_int={x_interval}, grid_int={self.chart.vertical_grid_lines.interval if self.chart.vertical_grid_lines else 'N/A'})")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Axes set: Y({self.chart.min_y:.0f}-{self.chart.max_y:.0f}, grid={self.chart.horizontal_grid_lines.interval if self.chart.horizontal_grid_lines else 'N/A'}), X({self.chart.min_x}-{self.chart.max_x:.1f}, label_int={x_interval}, grid_int={self.chart.vertical_grid_lines.interval if self.chart.vertical_grid_lines else 'N/A'})")
 
 
-            # --- 9. グラフ下の情報テキストをクリア ---
-            self.hide_point_info() # updateも内部で呼ぶ
+            # --- 8. グラフ下の情報テキストをクリア ---
+            self.info_text.value = "" # updateは次の self.update() に任せる
 
-            # --- 10. グラフ全体のUI更新 ---
+            # --- 9. グラフ全体のUI更新 (統計・グラフ・情報テキストを1回で送る) ---
             self.update()
-            print("[DEBUG Graph] load_points: 完了")
+            logger.debug("load_points: 完了")
 
         except Exception as load_ex:
-            print(f"[ERROR] graph_view load_points でエラーが発生しました: {load_ex}")
-            traceback.print_exc()
             # エラー発生時もグラフをクリアする
-            self.points = []
-            self.distances = []
-            self.chart.data_series = []
-            self.stats_text.value = "エラーが発生しました"
-            self.hide_point_info()
-            self.update()
+            self._show_error(load_ex)
+
+    def index_at_km(self, km: float) -> int:
+        """
+        累積距離 km の位置にあるポイントのインデックスを二分探索で返す (ポイントがなければ -1)。
+        同じ距離のポイントが続く (停止中など) 場合はその先頭になるので、グラフのデータポイントからは使わない。
+        """
+        n = len(self._distances_arr)
+        if n == 0:
+            return -1
+        return min(int(np.searchsorted(self._distances_arr, km)), n - 1)
+
+    def _handle_chart_event(self, e: ft.LineChartEvent):
+        """グラフ上のカーソル位置 (データポイント) を元のポイントのインデックスに直して通知する"""
+        if self.on_point_hover is None:
+            return
+        spots = e.spots or []
+        idx = -1
+        if spots and e.type not in ("PointerExitEvent", "FlPointerExitEvent"):
+            spot = spots[0]
+            spot_index = spot.get("spot_index", -1) if isinstance(spot, dict) else spot.spot_index
+            if 0 <= spot_index < len(self._chart_src_idx):
+                idx = int(self._chart_src_idx[spot_index])
+        self.on_point_hover(idx)
 
     def highlight(self, index: int):
         """指定されたインデックスの情報を表示"""
-        if 0 <= index < len(self.points) and index < len(self.distances):
-            p = self.points[index]
+        if 0 <= index < len(self.ele) and index < len(self.distances):
             dist_km = self.distances[index]
-            ele_m = p.get('ele', 0.0)
-            time_obj = p.get('time') # datetime オブジェクトを取得
+            ele_m = self.ele[index]
+            time_obj = self.time[index] # datetime オブジェクトを取得
             time_str = time_obj.strftime('%H:%M:%S') if isinstance(time_obj, datetime) else "--:--:--"
+            ele_str = f"{ele_m:.1f}m" if np.isfinite(ele_m) else "-" # 高度なしは NaN
 
-            self.info_text.value = f"{time_str} - 距離:{dist_km:.2f}km / 標高:{ele_m:.1f}m"
+            self.info_text.value = f"{time_str} - 距離:{dist_km:.2f}km / 標高:{ele_str}"
             self.info_text.update() # テキストのみ更新
-            # print(f"[GraphView] Showing info for index {index}")
+            # logger.debug("Showing info for index %d", index)
         else:
             self.hide_point_info()
 
@@ -1,39 +1,87 @@
 # gpxhandle/list_view.py
 
 import flet as ft
-from typing import List, Dict, Callable, Optional, Tuple, Set
+import math
+import logging
+import threading
+from collections import deque
+from itertools import compress
+from typing import List, Dict, Callable, Deque, Optional, Tuple
 from datetime import datetime
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+def _serialized(method):
+    """行データ (points・controls・選択状態) を読み書きするメソッドを self._rows_lock で直列化するデコレータ。
+    Flet は同期のイベントハンドラーをワーカースレッドで呼ぶので、スクロールと削除・アンドゥが同時に走ることがある。"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._rows_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class TrackList(ft.ListView):
     """トラックポイント一覧 (複数回アンドゥ対応)"""
     ITEM_HEIGHT = 55
+    PADDING = 5 # リスト上下左右の余白。行の間隔は 0 なので、idx 行目の上端は PADDING + idx * ITEM_HEIGHT
+    UNDO_LIMIT = 128  # 保持するアンドゥ履歴の最大数 (超えた分は古いものから破棄)
+    WINDOW_ROWS = 200 # 表示位置の前後で ListTile を実体化する行数 (範囲外は軽量なプレースホルダー)
+    SCROLL_INTERVAL_MS = 100 # on_scroll を送る最短間隔 (ドラッグの1ピクセルごとに表示範囲を計算し直さない)
+    _KEEP_TABLE = bytes([1, 0]) + bytes(254) # 選択マスクの 0/1 を反転する bytes.translate 用テーブル
 
     def __init__(self, on_select: Callable[[int], None], 
-                 on_data_change: Callable[[], None],
+                 on_data_change: Callable[[Optional[Dict]], None],
                  on_multi_selection_change: Callable[[bool], None]):
-        super().__init__(expand=True, spacing=2, padding=5)
+        # 行の高さを item_extent で固定し、Flutter 側でレイアウト計算なしに仮想化させる
+        # (行間を空けるとスクロール位置の計算とずれるので spacing は 0)
+        super().__init__(expand=True, spacing=0, padding=self.PADDING,
+                         item_extent=self.ITEM_HEIGHT, cache_extent=self.ITEM_HEIGHT * 20,
+                         on_scroll=self._handle_scroll, on_scroll_interval=self.SCROLL_INTERVAL_MS)
         self.on_select_cb = on_select
+        # 変更内容 {"op": "delete"|"insert", "indices": [...]} を渡す (None は全体の再読込を表す)
+        # delete の indices は削除前の位置、insert の indices は挿入後の位置 (いずれも昇順)
         self.on_data_change_cb = on_data_change
         self.on_multi_selection_change_cb = on_multi_selection_change
         self.points: List[Dict] = []
         self.idx: int = -1  # 単一選択ハイライト用インデックス
-        self.selected_indices: Set[int] = set()  # 複数選択されたインデックス
-
-        # アンドゥ履歴用スタック
-        # (削除されたインデックス, 削除されたポイントデータ) のタプルのリスト
-        self._undo_stack: List[Tuple[int, Dict]] = []
+        self._idx_offset: int = 0  # ハイライト行のスクロール位置 (_row_offset(idx))。idx と同時に更新する
+        # 複数選択 (チェックボックス) の状態。self.points と同じ長さで、選択された行が 1
+        self._sel_mask: bytearray = bytearray()
+        self._sel_count: int = 0  # 選択されている行数 (_sel_mask の 1 の数)
+
+        # アンドゥ履歴用スタック (上限付き)
+        # (削除されたインデックスのリスト, 削除されたポイントデータのリスト) のタプル
+        # 削除したポイントの辞書は self.points から外れて他から参照されないので、コピーせずそのまま保持する
+        self._undo_stack: Deque[Tuple[List[int], List[Dict]]] = deque(maxlen=self.UNDO_LIMIT)
+
+        # ListTile を実体化している行範囲 [start, end)。範囲外の行は同じ高さの空の Container
+        self._window: Tuple[int, int] = (0, 0)
+        # 表示から外れた ListTile を作り直さずに再利用するためのプール (末尾から取り出す)
+        self._tile_pool: List[ft.ListTile] = []
+        # リスト再構築中だけ使う、直前のプレースホルダーの再利用プール
+        self._placeholder_pool: List[ft.Container] = []
+        # おおよその表示範囲 (on_scroll で更新)。高さ 0 は未取得を表す
+        self._viewport_top: float = 0.0
+        self._viewport_h: float = 0.0
 
         # 処理中フラグ
         self._is_processing: bool = False
+        # 行データを変更・参照するハンドラー (スクロール・クリック・削除・アンドゥ等) を直列化するロック (_serialized)
+        # 通知先から同じスレッドで再び呼ばれても止まらないよう RLock にする
+        self._rows_lock = threading.RLock()
 
+    @_serialized
     def load_points(self, points: List[Dict]):
         """リストを更新し、アンドゥ履歴をクリア、最初の項目を選択"""
         self.points = points
         self.idx = -1
+        self._window = (0, 0) # 先頭付近から実体化する
 
         # ロード時にクリア
         self._undo_stack.clear()
-        self.selected_indices.clear()
+        self._sel_mask = bytearray(len(points))
+        self._sel_count = 0
         self._last_click_index = -1
         self._refresh_list()
 
@@ -51,22 +99,139 @@ class TrackList(ft.ListView):
     def _refresh_list(self):
         """現在の self.points に基づいてリスト表示を完全に再構築する。"""
         current_highlight_idx = self.idx  # ハイライト位置
+        # 直前の行コントロールは作り直さずに再利用する (並び順を保つよう逆順でプールに入れる)
+        old_rows = self.controls[::-1]
         self.controls.clear()
+        self._release_tiles(old_rows)
+        self._placeholder_pool = [row for row in old_rows if type(row) is ft.Container]
         if not self.points:
             self.controls.append(ft.Text("データがありません", italic=True))
             self.idx = -1
         else:
-            for i, p in enumerate(self.points):
-                self.controls.append(self._create_list_tile(i, p))
+            # ハイライト位置 (なければ直前の表示範囲) の周辺だけを ListTile にする
+            if 0 <= current_highlight_idx < len(self.points):
+                center = current_highlight_idx
+            else:
+                center = min(sum(self._window) // 2, len(self.points) - 1)
+            self._window = self._window_range(center)
+            self.controls.extend(self._create_row(i) for i in range(len(self.points)))
             # ハイライト位置を復元
             self.idx = -1 # 一旦リセット
             if 0 <= current_highlight_idx < len(self.points):
                 self._update_highlight(current_highlight_idx) # ハイライト再設定
             else: # 有効なハイライトがなければ未選択(-1)のまま
                  pass
+        self._placeholder_pool = [] # 余ったプレースホルダーは破棄する
         # updateは呼び出し元で行う
 
-    def _create_list_tile(self, i: int, p: Dict) -> ft.ListTile:
+    @property
+    def has_selection(self) -> bool:
+        """チェックされた行が1つ以上あるかどうか。"""
+        return self._sel_count > 0
+
+    @property
+    def selected_indices(self) -> List[int]:
+        """チェックされた行のインデックスを昇順で返す。"""
+        return [i for i, selected in enumerate(self._sel_mask) if selected]
+
+    @staticmethod
+    def _format_labels(p: Dict) -> Tuple[str, str]:
+        """ポイントの表示文字列 (時刻, 座標/標高) を作成する。"""
+        ts = p.get("time")
+        # "%Y-%m-%d %H:%M:%S" と同じ文字列。strftime より速い isoformat の先頭19文字 (タイムゾーン部分を除く) を使う
+        time_str = ts.isoformat(" ", "seconds")[:19] if isinstance(ts, datetime) else "時刻なし"
+        ele = p.get("ele")
+        ele_str = f"{ele:.1f}m" if isinstance(ele, (int, float)) and math.isfinite(ele) else "-" # 高度なしは NaN
+        subtitle_str = f"Lat: {p['lat']:.5f}, Lon: {p['lon']:.5f}, Ele: {ele_str}"
+        return time_str, subtitle_str
+
+    def _window_range(self, center: int) -> Tuple[int, int]:
+        """center 行の前後 WINDOW_ROWS 行の範囲 [start, end) を返す。"""
+        start = max(0, center - self.WINDOW_ROWS)
+        end = min(len(self.points), center + self.WINDOW_ROWS + 1)
+        return start, end
+
+    def _row_offset(self, i: int) -> int:
+        """i 行目の上端のスクロール位置を返す。"""
+        return self.PADDING + i * self.ITEM_HEIGHT
+
+    def _create_placeholder(self, i: int) -> ft.Container:
+        """表示範囲外の行の代わりに置く、ListTile と同じ高さの空コントロールを作成する (プールがあれば再利用)。"""
+        if self._placeholder_pool:
+            placeholder = self._placeholder_pool.pop()
+            placeholder.data = i
+            return placeholder
+        return ft.Container(height=self.ITEM_HEIGHT, data=i)
+
+    def _release_tiles(self, rows: List[ft.Control]):
+        """表示から外した行のうち ListTile をプールに戻す (表示範囲の行数を上限とする)。"""
+        limit = 2 * self.WINDOW_ROWS + 1
+        for row in rows:
+            if len(self._tile_pool) >= limit:
+                break
+            if isinstance(row, ft.ListTile):
+                self._tile_pool.append(row)
+
+    def _create_row(self, i: int) -> ft.Control:
+        """i 行目のコントロールを作成する。表示範囲内なら ListTile、範囲外ならプレースホルダー。"""
+        start, end = self._window
+        if start <= i < end:
+            return self._create_list_tile(i)
+        return self._create_placeholder(i)
+
+    def _ensure_window(self, center: int, force: bool = False) -> bool:
+        """center 行が表示範囲の中央付近から外れていれば、範囲を移動して ListTile を作り直す。
+        範囲内の行を ListTile に、外れた行をプレースホルダーに置き換える。変更があれば True。(UI更新は行わない)
+        行の追加・削除で範囲内にプレースホルダーがずれ込んだ場合は force=True で埋め直す。"""
+        if not self.points:
+            return False
+        start, end = self._window
+        margin = self.WINDOW_ROWS // 2
+        if not force and start + margin <= center < end - margin:
+            return False
+        new_start, new_end = self._window_range(center)
+        if not force and (new_start, new_end) == (start, end):
+            return False
+        self._window = (new_start, new_end)
+        for i in range(start, min(end, len(self.controls))):
+            if not (new_start <= i < new_end) and isinstance(self.controls[i], ft.ListTile):
+                self._release_tiles([self.controls[i]])
+                self.controls[i] = self._create_placeholder(i)
+        for i in range(new_start, new_end):
+            if not isinstance(self.controls[i], ft.ListTile):
+                self.controls[i] = self._create_list_tile(i)
+        return True
+
+    @_serialized
+    def _handle_scroll(self, e: ft.OnScrollEvent):
+        """スクロール位置を記録し、それに合わせて ListTile を実体化する範囲を移動する。"""
+        self._viewport_top = e.pixels
+        self._viewport_h = e.viewport_dimension
+        if not self.points:
+            return
+        top_row = int(max(e.pixels - self.PADDING, 0) // self.ITEM_HEIGHT)
+        visible_rows = int(e.viewport_dimension // self.ITEM_HEIGHT)
+        center = min(top_row + visible_rows // 2, len(self.points) - 1)
+        if self._ensure_window(center):
+            self.update()
+
+    def _ensure_visible(self, duration: int = 0) -> bool:
+        """
+        ハイライト行が表示範囲の外にあるときだけ、その行までスクロールする。
+        スクロールした場合は scroll_to が内部で update するので True を返す (呼び出し元は update 不要)。
+        ハイライトがなければ何もせず False を返す。
+        """
+        if self.idx < 0:
+            return False
+        offset = self._idx_offset
+        if self._viewport_h > 0 and \
+                self._viewport_top <= offset <= self._viewport_top + self._viewport_h - self.ITEM_HEIGHT:
+            return False # 既に見えている
+        self.scroll_to(offset=offset, duration=duration)
+        self._viewport_top = offset # 次のスクロールイベントまでの見込み値
+        return True
+
+    def _create_list_tile(self, i: int) -> ft.ListTile:
         # """ListTileコントロールを作成する (直接削除ボタン付き)。"""
         # ts = p.get("time")
         # time_str = ts.strftime("%Y-%m-%d %H:%M:%S") if isinstance(ts, datetime) else "時刻なし"
@@ -80,65 +245,78 @@ class TrackList(ft.ListView):
         #         data=i, on_click=self._delete_point # 直接削除
         #     )
         # )
-        """ListTileコントロールを作成する (チェックボックス付き)。"""
-        ts = p.get("time")
-        time_str = ts.strftime("%Y-%m-%d %H:%M:%S") if isinstance(ts, datetime) else "時刻なし"
-        subtitle_str = f"Lat: {p['lat']:.5f}, Lon: {p['lon']:.5f}, Ele: {p.get('ele', 0.0):.1f}m"
+        """ListTileコントロールを作成する (チェックボックス付き)。
+        表示文字列は ListTile を実体化するこの時点で作る (表示範囲外の行の文字列は持たない)。
+        プールに ListTile があれば、作り直さずに値だけを差し替えて再利用する。"""
+        time_str, subtitle_str = self._format_labels(self.points[i])
+        if self._tile_pool:
+            tile = self._tile_pool.pop()
+            tile.title.value = time_str
+            tile.subtitle.value = subtitle_str
+            tile.data = i
+            tile.leading.data = i
+            tile.leading.value = bool(self._sel_mask[i])
+            tile.bgcolor = ft.Colors.BLUE_50 if i == self.idx else None
+            return tile
         return ft.ListTile(
             leading=ft.Checkbox(
-                value=(i in self.selected_indices), # 選択状態を反映
+                value=bool(self._sel_mask[i]), # 選択状態を反映
                 data=i,
                 on_change=self._handle_checkbox_change
             ),
             title=ft.Text(time_str), subtitle=ft.Text(subtitle_str, size=11),
             data=i,
+            bgcolor=ft.Colors.BLUE_50 if i == self.idx else None, # ハイライト中の行を範囲外から戻した場合
             on_click=self._handle_click, # ★ Shift 対応のクリック処理
             dense=True,
+            height=self.ITEM_HEIGHT, # プレースホルダー・item_extent と同じ高さに固定
         )
     
+    @_serialized
     def _handle_click(self, e: ft.ControlEvent):
         """ListTileクリック時の処理 (単一選択ハイライトのみ)。"""
         clicked_idx = e.control.data
         self._update_highlight(clicked_idx) # ハイライトを移動
+        self.on_select_cb(self.idx) # 単一選択コールバック (先に呼び、反映は下の update にまとめる)
         self.update() # ハイライト変更を反映
-        self.on_select_cb(self.idx) # 単一選択コールバック
 
+    @_serialized
     def _handle_checkbox_change(self, e: ft.ControlEvent):
         """チェックボックスの状態が変わったときの処理。"""
         idx = e.control.data
         is_selected = e.control.value
-        prev_selection_empty = not self.selected_indices
+        prev_selection_empty = not self.has_selection
 
+        new_value = 1 if is_selected else 0
+        self._sel_count += new_value - self._sel_mask[idx]
+        self._sel_mask[idx] = new_value
         if is_selected:
-            self.selected_indices.add(idx)
             # チェックを付けた行をハイライト（単一選択）の起点にもする
             self._last_click_index = idx
-        else:
-            self.selected_indices.discard(idx)
-            # チェックを外した場合、last_click_index は変更しない
+        # チェックを外した場合、last_click_index は変更しない
 
         # 選択状態の有無が変わった場合にのみコールバックを呼ぶ
-        current_selection_empty = not self.selected_indices
+        current_selection_empty = not self.has_selection
         if prev_selection_empty != current_selection_empty:
              self.on_multi_selection_change_cb(not current_selection_empty)
 
+    @_serialized
     def move_cursor(self, step: int): # 残しておく
         if not self.points: return
         if self.idx == -1: start_idx = 0 if step > 0 else len(self.points) - 1
         else: start_idx = self.idx
         new_idx = start_idx + step
         new_idx = max(0, min(len(self.points) - 1, new_idx))
-        self._update_selection(new_idx, scroll_to=True, trigger_callback=True)
-        self.update()
+        self._update_selection(new_idx, scroll_to=True, trigger_callback=True) # update は内部で1回だけ
 
     def _update_selection(self, new_idx: int, scroll_to: bool, trigger_callback: bool):
          # 単一選択ハイライト用メソッド (move_cursorから呼ばれる)
          if not (0 <= new_idx < len(self.controls)) or new_idx == self.idx: return
          self._update_highlight(new_idx)
-         if scroll_to:
-             offset = new_idx * self.ITEM_HEIGHT
-             self.scroll_to(offset=offset, duration=150)
-         self.update() # ハイライト変更を反映
+         self._ensure_window(new_idx) # 移動先の周辺を ListTile にする
+         # 移動先が見えていなければスクロール (内部で update される)、見えていればハイライト変更だけを反映
+         if not (scroll_to and self._ensure_visible(duration=150)):
+             self.update()
          # キーでのハイライト移動時もlast_click_indexを更新しておく
          self._last_click_index = new_idx
          if trigger_callback: self.on_select_cb(self.idx)
@@ -149,201 +327,290 @@ class TrackList(ft.ListView):
             control = self.controls[self.idx]
             if isinstance(control, ft.ListTile): control.bgcolor = None
         self.idx = new_idx
+        self._idx_offset = self._row_offset(new_idx) if new_idx >= 0 else 0
         if 0 <= self.idx < len(self.controls):
             new_control = self.controls[self.idx]
             if isinstance(new_control, ft.ListTile): new_control.bgcolor = ft.Colors.BLUE_50
 
+    def _reindex_from(self, start: int):
+        """start 以降の行に、現在の位置を表すインデックスを振り直す。(UI更新は行わない)"""
+        for i in range(start, len(self.controls)):
+            tile = self.controls[i]
+            tile.data = i
+            if isinstance(tile, ft.ListTile): # プレースホルダーにはチェックボックスがない
+                tile.leading.data = i
+
+    def _remove_rows(self, start: int, stop: int) -> List[Dict]:
+        """
+        [start, stop) の行を、行ごとに並行して持っているデータ (ポイント・行コントロール・選択状態)
+        からスライスでまとめて取り除き、取り除いたポイントを返す。インデックスの振り直しは呼び出し元で行う。
+        """
+        removed = self.points[start:stop]
+        self._release_tiles(self.controls[start:stop])
+        del self.points[start:stop]
+        del self.controls[start:stop]
+        self._sel_count -= self._sel_mask.count(1, start, stop)
+        del self._sel_mask[start:stop]
+        return removed
+
+    def _remove_selected_rows(self) -> Tuple[List[int], List[Dict]]:
+        """
+        チェックされた行を、行ごとのデータからまとめて取り除く。
+        1行ずつ pop すると削除のたびに後ろの要素がずれるため、選択マスクで残す行を1回の走査で選び直す。
+        取り除いた行の元のインデックス (昇順) とポイントを返す。インデックスの振り直しは呼び出し元で行う。
+        """
+        selected = self._sel_mask
+        keep = selected.translate(self._KEEP_TABLE) # 0/1 を反転した「残す行」のマスク
+        removed_indices = list(compress(range(len(selected)), selected))
+        removed_points = list(compress(self.points, selected))
+        self._release_tiles(list(compress(self.controls, selected)))
+        self.points[:] = compress(self.points, keep)
+        self.controls[:] = compress(self.controls, keep)
+        self._sel_mask = bytearray(len(self.points))
+        self._sel_count = 0
+        return removed_indices, removed_points
+
+    @staticmethod
+    def _merge_rows(old: list, positions: List[int], values: list) -> list:
+        """挿入後の位置 positions (昇順) に values を置き、old の要素で間を埋めたリストを1回の走査で作る。"""
+        merged = []
+        pos = 0
+        for new_idx, value in zip(positions, values):
+            take = new_idx - len(merged)
+            merged.extend(old[pos:pos + take])
+            pos += take
+            merged.append(value)
+        merged.extend(old[pos:])
+        return merged
+
+    def _insert_rows(self, indices: List[int], points: List[Dict]) -> List[int]:
+        """
+        元のインデックス indices (昇順) にポイントを戻し、行ごとのデータをそろえる (未選択で挿入)。
+        1件ずつ insert するとそのたびに後ろの要素がずれるため、連続した範囲はスライス代入で、
+        飛び飛びの場合は併合リストを作って一度に差し替える。実際に挿入した位置のリストを返す。
+        インデックスの振り直しは呼び出し元で行う。
+        """
+        # 挿入位置を現在のリスト長でクリップ (安全のため)。昇順に1件ずつ挿入した場合と同じ位置になる
+        n = len(self.points)
+        positions = [min(idx, n + k) for k, idx in enumerate(indices)]
+
+        start = positions[0]
+        if positions[-1] - start == len(positions) - 1:
+            # 連続した範囲 (前後の一括削除・単一削除のアンドゥ): スライス代入で一度に挿入
+            self.points[start:start] = points
+            self._sel_mask[start:start] = bytes(len(points))
+            self.controls[start:start] = [self._create_row(i) for i in positions]
+        else:
+            # 飛び飛び (チェックした行の一括削除のアンドゥ): 併合したリストで差し替える
+            self.points[:] = self._merge_rows(self.points, positions, points)
+            self._sel_mask[:] = self._merge_rows(self._sel_mask, positions, [0] * len(points))
+            self.controls[:] = self._merge_rows(self.controls, positions, [self._create_row(i) for i in positions])
+        return positions
+
+    def _restore_highlight(self, idx: int):
+        """行の追加・削除後にハイライトを設定する。範囲外なら未選択、空なら空表示にする。(UI更新は行わない)"""
+        if not self.points:
+            self._refresh_list() # 「データがありません」を表示
+        elif 0 <= idx < len(self.points):
+            self._update_highlight(idx)
+        else:
+            self._update_highlight(-1)
+
+    @_serialized
     def delete_before_selected(self):
         """現在ハイライトされているポイントより前のすべてを削除する。"""
         if self._is_processing or self.idx <= 0: # 未選択または先頭選択時は不可
-            print("[WARN] Cannot delete before: No valid selection or already processing.")
+            logger.warning("Cannot delete before: No valid selection or already processing.")
             return
         self._is_processing = True
-        print(f"Deleting points before index: {self.idx}")
+        logger.debug("Deleting points before index: %d", self.idx)
         try:
             indices_to_delete = list(range(0, self.idx))
-            deleted_data = [self.points[i].copy() for i in indices_to_delete]
+            deleted_data = self.points[0:self.idx] # 辞書の参照だけをスライスで取り出す
 
             if deleted_data:
                 self._undo_stack.append((indices_to_delete, deleted_data))
-                print(f"Undo stack size: {len(self._undo_stack)}")
-                del self.points[0:self.idx] # スライスで削除
-                # 削除後の新しい選択インデックスは 0
-                self.idx = 0
-                self._refresh_list() # updateなし
-                self.update()       # 更新
+                logger.debug("Undo stack size: %d", len(self._undo_stack))
+                # ポイントと行をスライスで削除し、残った行のインデックスを振り直す
+                self._remove_rows(0, self.idx)
+                self._reindex_from(0)
+                # 削除後の新しい選択インデックスは 0 (ハイライト中の行がそのまま先頭になる)
+                self._update_highlight(0)
+                self._ensure_window(0, force=True) # updateなし
+                if not self._ensure_visible(): # 先頭が見えていなければ移動 (内部で update される)
+                    self.update()
                 # 外部に通知
                 self.on_select_cb(self.idx)
-                self.on_multi_selection_change_cb(bool(self.selected_indices))
-                self.on_data_change_cb()
-            else: print("No points to delete before.")
+                self.on_multi_selection_change_cb(self.has_selection)
+                self.on_data_change_cb({"op": "delete", "indices": indices_to_delete})
+            else: logger.debug("No points to delete before.")
         finally:
             self._is_processing = False
-            print("Finished deleting points before.")
+            logger.debug("Finished deleting points before.")
 
+    @_serialized
     def delete_after_selected(self):
         """現在ハイライトされているポイントより後のすべてを削除する。"""
         if self._is_processing or self.idx < 0 or self.idx >= len(self.points) - 1: # 未選択または最後尾選択時は不可
-            print("[WARN] Cannot delete after: No valid selection or already processing.")
+            logger.warning("Cannot delete after: No valid selection or already processing.")
             return
         self._is_processing = True
-        print(f"Deleting points after index: {self.idx}")
+        logger.debug("Deleting points after index: %d", self.idx)
         try:
             start_delete_idx = self.idx + 1
             indices_to_delete = list(range(start_delete_idx, len(self.points)))
-            deleted_data = [self.points[i].copy() for i in indices_to_delete]
+            deleted_data = self.points[start_delete_idx:] # 辞書の参照だけをスライスで取り出す
 
             if deleted_data:
                 self._undo_stack.append((indices_to_delete, deleted_data))
-                print(f"Undo stack size: {len(self._undo_stack)}")
-                del self.points[start_delete_idx:] # スライスで削除
+                logger.debug("Undo stack size: %d", len(self._undo_stack))
+                # ポイントと行をスライスで削除 (前の行のインデックスは変わらない)
+                self._remove_rows(start_delete_idx, len(self.points))
                 # 選択インデックス self.idx は維持される
-                self._refresh_list() # updateなし
+                self._ensure_window(self.idx, force=True) # updateなし
                 self.update()       # 更新
                 # 外部に通知
                 self.on_select_cb(self.idx) # 選択は変わらない
-                self.on_multi_selection_change_cb(bool(self.selected_indices))
-                self.on_data_change_cb()
-            else: print("No points to delete after.")
+                self.on_multi_selection_change_cb(self.has_selection)
+                self.on_data_change_cb({"op": "delete", "indices": indices_to_delete})
+            else: logger.debug("No points to delete after.")
         finally:
             self._is_processing = False
-            print("Finished deleting points after.")
+            logger.debug("Finished deleting points after.")
 
+    @_serialized
     def _delete_point(self, e: ft.ControlEvent):
         """指定インデックスのポイントを削除し、アンドゥスタックに保存、外部に通知する。"""
         # --- ★★★ 処理中なら何もしない ★★★ ---
         if self._is_processing:
-            print("[WARN] Delete operation already in progress. Ignoring.")
+            logger.warning("Delete operation already in progress. Ignoring.")
             return
         
         # --- ★★★ 処理開始、フラグを立てる ★★★ ---
         self._is_processing = True
-        print(f"Deleting point start...")
+        logger.debug("Deleting point start...")
         try:
             idx_to_delete = e.control.data
             if not (0 <= idx_to_delete < len(self.points)):
                 self._is_processing = False # 無効なインデックスならフラグを戻す
                 return
 
-            print(f"Deleting point at index: {idx_to_delete}")
+            logger.debug("Deleting point at index: %d", idx_to_delete)
             # time.sleep(0.5) # ★ デバッグ: 意図的に遅延させてテストする場合 ★
-            deleted_data = self.points[idx_to_delete].copy()
-            self._undo_stack.append((idx_to_delete, deleted_data))
-            del self.points[idx_to_delete]
-
-            self._refresh_list() # 再描画指示 (updateなし)
-            self.update()       # ListView 更新
-
-            # 削除後の選択決定と通知
-            if self.idx >= 0:
-                self.on_select_cb(self.idx)
-                offset = self.idx * self.ITEM_HEIGHT
-                self.scroll_to(offset=offset, duration=150)
-            else:
-                self.on_select_cb(-1)
-            self.on_data_change_cb()
+            deleted_data = self.points[idx_to_delete]
+            # 他の削除操作と同じ (インデックスリスト, データリスト) 形式で保存
+            self._undo_stack.append(([idx_to_delete], [deleted_data]))
+
+            # 該当行だけを取り除き、後続行のインデックスを振り直す (リスト全体は再構築しない)
+            highlight_idx = self.idx
+            self._update_highlight(-1) # ハイライトを一旦解除
+            self._remove_rows(idx_to_delete, idx_to_delete + 1)
+            self._reindex_from(idx_to_delete)
+            self._restore_highlight(highlight_idx) # 同じ位置にハイライトを戻す (updateなし)
+            self._ensure_window(min(idx_to_delete, len(self.points) - 1), force=True) # 詰めた分の行を埋める
+
+            # ListView 更新は1回だけ行う (ハイライト行が見えていなければ scroll_to が内部で update する)
+            if not self._ensure_visible():
+                self.update()
+
+            # 更新後の状態を外部に通知
+            self.on_select_cb(self.idx)
+            self.on_data_change_cb({"op": "delete", "indices": [idx_to_delete]})
         finally:
             # --- ★★★ 処理完了、フラグを下ろす ★★★ ---
-            print(f"Deleting point finished.")
+            logger.debug("Deleting point finished.")
             self._is_processing = False
 
+    @_serialized
     def delete_selected(self):
         """チェックボックスで選択された項目を一括削除する。"""
-        if self._is_processing or not self.selected_indices:
-            print("[WARN] Deletion in progress or no selection.")
+        if self._is_processing or not self.has_selection:
+            logger.warning("Deletion in progress or no selection.")
             return
         self._is_processing = True
-        print(f"Deleting selected points: indices={sorted(list(self.selected_indices))}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deleting selected points: indices=%s", self.selected_indices)
         try:
-            deleted_items_for_undo: List[Tuple[int, Dict]] = []
-            indices_to_delete = sorted(list(self.selected_indices), reverse=True)
-
-            for index in indices_to_delete:
-                if 0 <= index < len(self.points):
-                    deleted_data = self.points.pop(index)
-                    deleted_items_for_undo.append((index, deleted_data))
-                else: print(f"[WARN] Invalid index during multi-delete: {index}")
-
-            if deleted_items_for_undo:
-                 deleted_items_for_undo.sort(key=lambda item: item[0])
-                 original_indices = [item[0] for item in deleted_items_for_undo]
-                 original_data = [item[1] for item in deleted_items_for_undo]
-                 self._undo_stack.append((original_indices, original_data))
-                 print(f"Undo stack size: {len(self._undo_stack)}")
+            highlight_idx = self.idx
+            self._update_highlight(-1) # ハイライトを一旦解除
+            # チェックされた行をまとめて取り除く (元のインデックスは昇順で得られる)
+            original_indices, original_data = self._remove_selected_rows()
 
-            # 選択状態をクリアし、リスト再描画、UI更新
-            self.selected_indices.clear()
-            self._refresh_list() # updateなし
+            if original_indices:
+                 self._undo_stack.append((original_indices, original_data))
+                 logger.debug("Undo stack size: %d", len(self._undo_stack))
+
+            # チェックされた行はすべて取り除かれたので選択状態は空。最初に削除した位置以降のインデックスを振り直して UI更新
+            if original_indices:
+                first_deleted_idx = original_indices[0]
+                self._reindex_from(first_deleted_idx)
+                self._ensure_window(min(first_deleted_idx, len(self.points) - 1), force=True)
+            self._restore_highlight(highlight_idx) # 同じ位置にハイライトを戻す (updateなし)
             self.update() # 最後にupdate
 
             # 外部に通知
             self.on_select_cb(self.idx) # 新しいハイライト位置
             self.on_multi_selection_change_cb(False) # 選択解除
-            self.on_data_change_cb() # データ変更
-        except Exception as del_ex:
-             print(f"[ERROR] Error during delete_selected: {del_ex}")
-             traceback.print_exc()
+            self.on_data_change_cb({"op": "delete", "indices": original_indices}) # データ変更
         finally:
             self._is_processing = False
-            print("Finished deleting selected points.")
+            logger.debug("Finished deleting selected points.")
 
     # --- ★★★ アンドゥ処理メソッド (アンドゥスタック使用) ★★★ ---
+    @_serialized
     def undo_delete(self):
         """直前の削除操作を元に戻す。アンドゥスタックから復元する。"""
         # --- ★★★ 処理中なら何もしない ★★★ ---
         if self._is_processing:
-            print("[WARN] Undo operation already in progress. Ignoring.")
+            logger.warning("Undo operation already in progress. Ignoring.")
             return False
 
         # --- ★★★ 処理開始、フラグを立てる ★★★ ---
         self._is_processing = True
-        print(f"Undo delete start...")
+        logger.debug("Undo delete start...")
         result = False # アンドゥ成功フラグ
         try:
             if not self._undo_stack:
-                print("アンドゥする削除操作がありません。")
+                logger.debug("アンドゥする削除操作がありません。")
                 return False # result は False のまま
 
             # スタックから (インデックスリスト, データリスト) を取得
             # ※ delete_selected で元のインデックス順 (昇順) にソートして保存されている前提
             indices, data_list = self._undo_stack.pop()
-            print(f"アンドゥ実行: インデックス {indices} に {len(data_list)} ポイントを復元します。")
-            print(f"Undo stack size after pop: {len(self._undo_stack)}")
-
-            # ★★★ インデックスが小さい順に挿入する ★★★
-            restored_count = 0
-            # zip で元のインデックスとデータをペアにする
-            for insert_idx, point_to_restore in zip(indices, data_list):
-                # 挿入位置を現在のリスト長でクリップ (安全のため)
-                actual_insert_idx = min(insert_idx, len(self.points))
-                self.points.insert(actual_insert_idx, point_to_restore)
-                restored_count += 1
-                # print(f"  - Inserted at {actual_insert_idx}") # デバッグ用
-
-            # リスト再描画、最後に復元した最初の項目を選択
-            self.idx = indices[0] if indices else -1 # 復元セットの最初のインデックス
-            self._refresh_list() # updateなし
-            self.update()       # 更新
-
-            # スクロールして表示 & 外部に通知
+            logger.debug("アンドゥ実行: インデックス %s に %d ポイントを復元します。", indices, len(data_list))
+            logger.debug("Undo stack size after pop: %d", len(self._undo_stack))
+
+            # ★★★ インデックスが小さい順に、元の位置へまとめて挿入する ★★★
+            # 復元した行の ListTile だけを作成して挿入する (リスト全体は再構築しない)
+            self._update_highlight(-1) # ハイライトを一旦解除
+            if not self.points:
+                self.controls.clear() # 「データがありません」の表示を取り除く
+            positions: List[int] = []
+            if indices:
+                positions = self._insert_rows(indices, data_list)
+                self._reindex_from(positions[0])
+
+            # 復元セットの最初の項目をハイライトし、その周辺を ListTile にする
+            self._restore_highlight(indices[0] if indices else -1) # updateなし
             if self.idx >= 0:
-                offset = self.idx * self.ITEM_HEIGHT
-                self.scroll_to(offset=offset, duration=150)
-                self.on_select_cb(self.idx)
-            else:
-                 self.on_select_cb(-1)
-            # アンドゥ後はチェックボックス選択は解除されている状態なのでFalseを通知
-            self.on_multi_selection_change_cb(False)
-            self.on_data_change_cb()
+                self._ensure_window(self.idx, force=True)
+
+            # 復元した行が見えていなければスクロール (scroll_to は内部で update する) & 外部に通知
+            if not self._ensure_visible():
+                self.update()
+            self.on_select_cb(self.idx)
+            # 復元した行は未チェック。既存行のチェック状態は維持されるので現在の有無を通知
+            self.on_multi_selection_change_cb(self.has_selection)
+            self.on_data_change_cb({"op": "insert", "indices": positions})
             result = True
         finally:
             # --- ★★★ 処理完了、フラグを下ろす ★★★ ---
-            print(f"Undo delete finished.")
+            logger.debug("Undo delete finished.")
             self._is_processing = False
         return result
 
     # --- アンドゥ可能か確認するためのプロパティ ---
     @property
     def can_undo(self) -> bool:
-        """アンドゥ可能な削除操作（履歴）が存在するかどうかを返す。"""
+        """アンドゥ可能な削除操作（履歴）が存在するかどうかを返す。上限を超えて破棄された操作は含まない。"""
         return bool(self._undo_stack) # スタックが空でないかチェック
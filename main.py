@@ -8,15 +8,60 @@ main.py
 ・地図データの表示切替
 """
 
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
 import flet as ft
 from pathlib import Path # ファイルパス操作で使用
 from gpx_handler import load_gpx, save_gpx, Point
 from list_view import TrackList
 from map_view import MapView, TILE_SOURCES
 from graph_view import ElevationGraph
-# 不要なインポートを削除: json, threading, Optional
 
-# --- 設定ファイル関連コードは削除 ---
+logger = logging.getLogger(__name__)
+
+# 地図タイル選択肢の (キー, 表示名)。起動時に1回だけ作る
+# (Option はコントロールなのでセッション間で共有せず、main ごとにこの値から作る)
+_TILE_OPTION_ITEMS: tuple[tuple[str, str], ...] = tuple((key, info["name"]) for key, info in TILE_SOURCES.items())
+# 保存ダイアログの既定フォルダ (ファイル未読込時)。起動時に1回だけ取得する
+_HOME = str(Path.home())
+# 前回の地図タイル・フォルダを次回の起動に引き継ぐための保存先
+_SETTINGS_FILE = Path(_HOME) / ".gpxhandle" / "state.json"
+
+def _load_settings() -> dict:
+    """前回保存した設定を読み込む (なければ・壊れていれば空)"""
+    try:
+        settings = json.loads(_SETTINGS_FILE.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("設定ファイルを読み込めません: %s", e)
+        return {}
+    return settings if isinstance(settings, dict) else {}
+
+def _save_settings(settings: dict):
+    """設定を保存する。書きかけのファイルが残らないよう一時ファイルに書いてから置き換える"""
+    try:
+        _SETTINGS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = _SETTINGS_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(settings, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, _SETTINGS_FILE)
+    except OSError as e:
+        logger.warning("設定ファイルを保存できません: %s", e)
+
+@dataclass
+class AppState:
+    """アプリの状態 (main 内のハンドラーから共有して書き換える)"""
+    file_path: Path | None = None
+    export_initial_dir: str = _HOME # 保存ダイアログの初期フォルダ (読み込んだファイルのフォルダ)
+    io_busy: bool = False # ファイルの読み書き中 (重ねて読み込まないようにする)
+    points: list[Point] = field(default_factory=list)
+    track_name: str = "-"
+    pending_highlight_idx: int = -1 # 地図・グラフに反映待ちの選択位置
+    highlight_scheduled: bool = False # ハイライトの反映を予約済みか
+    settings: dict = field(default_factory=dict) # 次回に引き継ぐ設定 (tile_key, last_dir)
 
 def main(page: ft.Page):
     # --- ウィンドウ初期サイズ (固定値) ---
@@ -30,17 +75,14 @@ def main(page: ft.Page):
     page.window_width = initial_width # 初期幅設定
     page.window_height = initial_height # 初期高さ設定
 
-    # --- リサイズイベントハンドラは削除 ---
-    # --- ウィンドウイベントハンドラは削除 ---
-
     # --- 状態変数 ---
-    current_file_path: Path | None = None
-    current_points: list[Point] = []
-    current_track_name: str = "-"
+    settings = _load_settings()
+    st = AppState(settings=settings, export_initial_dir=settings.get("last_dir") or _HOME)
 
     # --- UIインスタンス ---
-    map_view = MapView()
-    graph_view = ElevationGraph()
+    # 前回のタイルで開始。タイルのキャッシュサーバー (127.0.0.1) は同じマシンで表示するデスクトップ版でだけ使う
+    map_view = MapView(tile_key=settings.get("tile_key"), use_tile_cache=not page.web)
+    graph_view = ElevationGraph(on_point_hover=lambda idx: on_graph_hover(idx)) # on_graph_hover は下で定義
     # --- ボタン参照 ---
     export_btn_ref = ft.Ref[ft.ElevatedButton]() # エクスポートボタン用 Ref 追加
     delete_selected_btn_ref = ft.Ref[ft.ElevatedButton]()
@@ -49,84 +91,119 @@ def main(page: ft.Page):
     delete_after_btn_ref = ft.Ref[ft.ElevatedButton]()
 
     # --- UI更新用関数 ---
-    def update_status(message: str, color: str = ft.Colors.GREY_700):
-        """ステータステキストを更新"""
+    def update_status(message: str, color: str = ft.Colors.GREY_700, busy: bool = False,
+                      extra: tuple[ft.Control, ...] = ()):
+        """
+        ステータステキストと読み書き中の表示 (プログレスリング) を更新。
+        extra に渡した変更済みのコントロールも同じ page.update でまとめて反映する。
+        """
         status_text.value = message
         status_text.color = color
-        status_text.update()
-
-    def update_range_delete_buttons_state(selected_idx: int):
-        """選択状態に基づいて前/後削除ボタンの有効/無効を更新"""
+        busy_ring.visible = busy
+        page.update(status_text, busy_ring, *extra)
+
+    # ボタン状態の set_*_state は disabled を書き換えるだけで、状態が変わったボタンのリストを返す。
+    # 画面への反映は flush_controls でまとめて1回行う (ボタンごとの update() は1回ずつ送信されるため)
+    def flush_controls(controls: list[ft.Control]):
+        """変更のあったコントロールだけを1回の page.update でまとめて反映"""
+        if controls:
+            page.update(*controls)
+
+    def set_enabled(button_ref: ft.Ref[ft.ElevatedButton], enabled: bool) -> list[ft.Control]:
+        """ボタンの有効/無効を設定し、実際に変わった場合のみ反映対象として返す"""
+        button = button_ref.current
+        if button is None or button.disabled == (not enabled):
+            return [] # 未作成、または状態が変わらない (UIへの送信不要)
+        button.disabled = not enabled
+        return [button]
+
+    def set_range_delete_buttons_state(selected_idx: int) -> list[ft.Control]:
+        """選択状態に基づいて前/後削除ボタンの有効/無効を設定"""
         # track_list が初期化されていない場合も考慮
         points_count = len(track_list.points) if track_list else 0
         can_delete_before = selected_idx > 0
         can_delete_after = 0 <= selected_idx < points_count - 1
+        return set_enabled(delete_before_btn_ref, can_delete_before) + set_enabled(delete_after_btn_ref, can_delete_after)
+
+    def set_delete_selected_button_state(has_selection: bool) -> list[ft.Control]:
+        """選択項目削除ボタンの状態設定"""
+        return set_enabled(delete_selected_btn_ref, has_selection)
+
+    def set_undo_button_state() -> list[ft.Control]:
+        """アンドゥボタンの状態設定"""
+        return set_enabled(undo_btn_ref, track_list.can_undo if track_list else False)
 
-        if delete_before_btn_ref.current:
-             delete_before_btn_ref.current.disabled = not can_delete_before
-             delete_before_btn_ref.current.update()
-        if delete_after_btn_ref.current:
-             delete_after_btn_ref.current.disabled = not can_delete_after
-             delete_after_btn_ref.current.update()
+    def set_export_button_state() -> list[ft.Control]:
+        """エクスポートボタンの状態設定"""
+        return set_enabled(export_btn_ref, bool(st.points))
+
+    def update_range_delete_buttons_state(selected_idx: int):
+        """選択状態に基づいて前/後削除ボタンの有効/無効を更新"""
+        flush_controls(set_range_delete_buttons_state(selected_idx))
 
     def update_delete_selected_button_state(has_selection: bool):
         """選択項目削除ボタンの状態更新"""
-        try:
-            if delete_selected_btn_ref.current:
-                delete_selected_btn_ref.current.disabled = not has_selection
-                delete_selected_btn_ref.current.update()
-        except Exception as e:
-            print(f"Error updating delete selected button: {e}")
+        flush_controls(set_delete_selected_button_state(has_selection))
 
     def update_undo_button_state():
         """アンドゥボタンの状態更新"""
-        try:
-            if undo_btn_ref.current:
-                can_undo = track_list.can_undo if track_list else False
-                # 状態が変わる場合のみ update
-                if undo_btn_ref.current.disabled == can_undo:
-                    undo_btn_ref.current.disabled = not can_undo
-                    undo_btn_ref.current.update()
-        except Exception as e:
-            print(f"Error updating undo button: {e}")
-
-    def update_export_button_state():
-        """エクスポートボタンの状態更新"""
-        try:
-            if export_btn_ref.current:
-                can_export = bool(current_points)
-                # 状態が変わる場合のみ update
-                if export_btn_ref.current.disabled == can_export:
-                    export_btn_ref.current.disabled = not can_export
-                    export_btn_ref.current.update()
-        except Exception as e:
-            print(f"Error updating export button: {e}")
+        flush_controls(set_undo_button_state())
 
     def update_all_button_states():
-        """関連する全てのボタンの状態を更新"""
-        update_export_button_state()
-        update_range_delete_buttons_state(track_list.idx if track_list else -1)
-        update_delete_selected_button_state(bool(track_list.selected_indices) if track_list else False)
-        update_undo_button_state()
+        """関連する全てのボタンの状態を更新 (反映は1回にまとめる)"""
+        flush_controls(
+            set_export_button_state()
+            + set_range_delete_buttons_state(track_list.idx if track_list else -1)
+            + set_delete_selected_button_state(track_list.has_selection if track_list else False)
+            + set_undo_button_state()
+        )
 
     # --- コールバック関数 ---
-    def on_list_select(idx: int):
-        """リスト選択時のコールバック"""
+    # 地図・グラフのハイライトは選択のたびには送らず、HIGHLIGHT_INTERVAL_SEC ごとに最新の位置だけを反映する
+    HIGHLIGHT_INTERVAL_SEC = 0.04
+
+    async def flush_highlight():
+        """待機後、その時点で最新の選択位置を地図・グラフにハイライト"""
+        await asyncio.sleep(HIGHLIGHT_INTERVAL_SEC)
+        st.highlight_scheduled = False
+        idx = st.pending_highlight_idx
         if idx >= 0:
             map_view.highlight(idx)
             graph_view.highlight(idx)
         else:
             map_view.highlight(-1)
             graph_view.hide_point_info()
+
+    def schedule_highlight(idx: int):
+        """地図・グラフのハイライトを idx に更新する (反映は flush_highlight でまとめて行う)"""
+        st.pending_highlight_idx = idx
+        # 反映待ちがなければ予約する (連続したキー操作中も一定間隔で最新位置が反映される)
+        if not st.highlight_scheduled:
+            st.highlight_scheduled = True
+            page.run_task(flush_highlight)
+
+    def on_list_select(idx: int):
+        """リスト選択時のコールバック"""
+        schedule_highlight(idx)
         # 範囲削除ボタンの状態を更新
         update_range_delete_buttons_state(idx)
 
-    def on_track_data_change():
-        """リストデータ変更時(削除/アンドゥ)のコールバック"""
-        nonlocal current_points
-        current_points = track_list.points # 最新データを反映
-        map_view.refresh() # 地図更新
-        graph_view.load_points(current_points)  # グラフ更新
+    def on_graph_hover(idx: int):
+        """グラフ上のカーソル位置を地図にハイライト。グラフから外れたらリストの選択位置に戻す"""
+        schedule_highlight(idx if idx >= 0 else track_list.idx)
+
+    def on_track_data_change(change: dict | None = None):
+        """
+        リストデータ変更時(削除/アンドゥ)のコールバック。
+        change ({"op": "delete"|"insert", "indices": [...]}) があれば、変わった点だけを地図・グラフに反映する。
+        """
+        st.points = track_list.points # 最新データを反映 (コピーではなく同じリストを参照)
+        if change is None:
+            map_view.refresh() # 地図更新
+            graph_view.load_points(st.points)  # グラフ更新
+        else:
+            map_view.apply_delta(change)
+            graph_view.apply_delta(change)
         # ハイライト更新
         current_idx = track_list.idx
         on_list_select(current_idx) # 選択状態に基づいてハイライトと範囲削除ボタンを更新
@@ -143,53 +220,65 @@ def main(page: ft.Page):
     # --- トラック名の編集用 ---
     track_name_input = ft.TextField(
         label="トラック名",
-        value=current_track_name,
+        value=st.track_name,
         dense=True,
         expand=True,
     )
 
     # --- ファイルピッカー関連 ---
-    def open_gpx_result(e: ft.FilePickerResultEvent):
-        nonlocal current_file_path, current_points, current_track_name
+    async def open_gpx_result(e: ft.FilePickerResultEvent):
         if not e.files or not e.files[0].path:
             update_status("ファイル選択キャンセル", ft.Colors.ORANGE_700)
             return
+        if st.io_busy:
+            return # 読み書き中に届いた結果は無視する
+        st.io_busy = True
         selected_path = Path(e.files[0].path)
+        open_btn.disabled = True # 読み込みが終わるまで次のファイルを開けないようにする
+        update_status(f"読み込み中: {selected_path.name}", busy=True, extra=(open_btn,))
         try:
-            pts, name = load_gpx(selected_path)
-            current_file_path = selected_path
-            current_points = pts
+            # 解析は別スレッドで行い、その間も UI を応答させる (コントロールの更新は戻ってから行う)
+            pts, name = await asyncio.to_thread(load_gpx, selected_path)
+            st.file_path = selected_path
+            st.export_initial_dir = str(selected_path.parent)
+            st.settings["last_dir"] = st.export_initial_dir
+            _save_settings(st.settings)
+            st.points = pts
             # GPXファイルに名前がない場合はファイル名から取得
-            current_track_name = name if name else selected_path.stem
-            track_name_input.value = current_track_name
-            track_name_input.update()
+            st.track_name = name if name else selected_path.stem
+            track_name_input.value = st.track_name
 
             map_view.load_points(pts)
             track_list.load_points(pts)
             graph_view.load_points(pts)
-            update_status(f"読み込み完了: {selected_path.name}", ft.Colors.GREEN_700)
+            open_btn.disabled = False
+            update_status(f"読み込み完了: {selected_path.name}", ft.Colors.GREEN_700, extra=(track_name_input, open_btn))
         except Exception as ex:
-            current_file_path = None
-            current_points = []
-            current_track_name = "-"
-            track_name_input.value = current_track_name
-            track_name_input.update()
+            st.file_path = None
+            st.export_initial_dir = st.settings.get("last_dir") or _HOME
+            st.points = []
+            st.track_name = "-"
+            track_name_input.value = st.track_name
             map_view.load_points([])
             track_list.load_points([])
             graph_view.load_points([])
-            update_status(f"読込エラー: {ex}", ft.Colors.RED_700)
+            open_btn.disabled = False
+            update_status(f"読込エラー: {ex}", ft.Colors.RED_700, extra=(track_name_input, open_btn))
         finally:
+            st.io_busy = False
             # 読み込み後、選択状態をリセットし、ボタン状態を更新
             on_list_select(-1)
             update_all_button_states()
 
-    def save_gpx_result(e: ft.FilePickerResultEvent):
+    async def save_gpx_result(e: ft.FilePickerResultEvent):
         if not e.path:
             update_status("保存キャンセル", ft.Colors.ORANGE_700)
             return
-        if not current_points:
+        if not st.points:
              update_status("保存するデータがありません", ft.Colors.ORANGE_700)
              return
+        if st.io_busy:
+            return # 読み書き中に届いた結果は無視する
 
         save_path = Path(e.path)
         # 拡張子が .gpx でなければ追加
@@ -199,15 +288,21 @@ def main(page: ft.Page):
         try:
             # TextField からトラック名を取得 (空ならデフォルト名)
             track_name_to_save = track_name_input.value.strip() or "GPX Track"
-            save_gpx(current_points, save_path, track_name_to_save)
+            st.io_busy = True
+            update_status(f"保存中: {save_path.name}", busy=True)
+            # 書き出しは別スレッドで行う。書き出し中に削除されても影響しないよう、その時点の並びを渡す
+            await asyncio.to_thread(save_gpx, list(st.points), save_path, track_name_to_save)
             update_status(f"保存しました: {save_path.name}", ft.Colors.GREEN_700)
         except Exception as ex:
             update_status(f"保存エラー: {ex}", ft.Colors.RED_700)
+        finally:
+            st.io_busy = False
 
     file_picker = ft.FilePicker(on_result=open_gpx_result)
     save_picker = ft.FilePicker(on_result=save_gpx_result)
     page.overlay.extend([file_picker, save_picker])
     status_text = ft.Text("GPXファイルを開いてください", color=ft.Colors.GREY_700, size=12)
+    busy_ring = ft.ProgressRing(width=14, height=14, stroke_width=2, visible=False) # 読み書き中の表示
 
     # --- 地図クレジット表示用テキスト ---
     map_attribution_text = ft.Text(
@@ -218,23 +313,30 @@ def main(page: ft.Page):
     # --- イベントハンドラ (ボタンクリック等) ---
     def open_gpx(e):
         """「ファイルを開く」ボタンのハンドラ"""
-        file_picker.pick_files(dialog_title="GPXを開く", allowed_extensions=["gpx"])
+        if st.io_busy:
+            return
+        file_picker.pick_files(dialog_title="GPXを開く", initial_directory=st.settings.get("last_dir"), allowed_extensions=["gpx"])
 
     def export_gpx(e):
         """「名前を付けて保存」ボタンのハンドラ"""
-        if not current_points:
+        if not st.points:
             update_status("保存するデータがありません", ft.Colors.RED)
             return
         initial_filename = f"{track_name_input.value.strip() or 'track'}.gpx"
-        initial_dir = str(current_file_path.parent) if current_file_path else str(Path.home())
-        save_picker.save_file(dialog_title="名前を付けて保存", file_name=initial_filename, initial_directory=initial_dir, allowed_extensions=["gpx"])
+        save_picker.save_file(dialog_title="名前を付けて保存", file_name=initial_filename, initial_directory=st.export_initial_dir, allowed_extensions=["gpx"])
 
     def handle_tile_change(e):
         """地図タイル変更時のハンドラ"""
         selected_key = e.control.value
         map_view.change_tile_layer(selected_key)
-        map_attribution_text.value = map_view.get_current_tile_attribution()
-        map_attribution_text.update()
+        if st.settings.get("tile_key") != map_view.current_tile_key:
+            st.settings["tile_key"] = map_view.current_tile_key # 次回もこのタイルで開始する
+            _save_settings(st.settings)
+        attribution = map_view.get_current_tile_attribution() # TILE_SOURCES を引くだけ (整形はしない)
+        # 地理院地図どうしの切り替えなどクレジットが同じ場合は送信しない
+        if map_attribution_text.value != attribution:
+            map_attribution_text.value = attribution
+            map_attribution_text.update()
 
     def handle_delete_before(e):
         """「前削除」ボタンのハンドラ"""
@@ -278,7 +380,7 @@ def main(page: ft.Page):
     # --- 地図タイル選択ドロップダウン ---
     tile_dropdown = ft.Dropdown(
         label="地図タイル", hint_text="地図を選択", expand=True, dense=True,
-        options=[ft.dropdown.Option(key=key, text=info["name"]) for key, info in TILE_SOURCES.items()],
+        options=[ft.dropdown.Option(key=key, text=name) for key, name in _TILE_OPTION_ITEMS],
         value=map_view.current_tile_key, # MapView の初期キーを使用
         on_change=handle_tile_change,
     )
@@ -298,13 +400,13 @@ def main(page: ft.Page):
                             [
                                 ft.IconButton(
                                     icon=ft.Icons.ADD, tooltip="ズームイン",
-                                    on_click=lambda _: map_view.zoom_in(),
+                                    on_click=map_view.zoom_in,
                                     bgcolor=ft.colors.with_opacity(0.7, ft.Colors.WHITE),
                                     icon_color=ft.Colors.BLACK, icon_size=18, height=30, width=30,
                                 ),
                                 ft.IconButton(
                                     icon=ft.Icons.REMOVE, tooltip="ズームアウト",
-                                    on_click=lambda _: map_view.zoom_out(),
+                                    on_click=map_view.zoom_out,
                                     bgcolor=ft.colors.with_opacity(0.7, ft.Colors.WHITE),
                                     icon_color=ft.Colors.BLACK, icon_size=18, height=30, width=30,
                                 ),
@@ -362,7 +464,7 @@ def main(page: ft.Page):
                 expand=True # 高さを可能な限り広げる
             ),
             ft.Container( # ステータス表示エリア
-                content=status_text,
+                content=ft.Row([busy_ring, status_text], spacing=6),
                 padding=ft.padding.only(top=8, bottom=2)
             )
         ],
@@ -381,7 +483,6 @@ def main(page: ft.Page):
 
     # --- アプリケーション開始時にボタンの状態を初期化 ---
     update_all_button_states()
-    # page.update() # page.add の後、通常は自動で update される
 
 if __name__ == "__main__":
     ft.app(target=main)
\ No newline at end of file
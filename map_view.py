@@ -2,81 +2,233 @@
 
 import flet as ft
 import flet_map as fmap # flet-map == 0.1.0
-from typing import List, Dict, Optional
-import traceback # エラー表示用
+from typing import Iterator, List, Dict, Optional
+import asyncio
+import logging
+import threading
+import time
+from types import MappingProxyType
+from contextlib import contextmanager
+from bisect import bisect_right
+import numpy as np
+from gpx_handler import rdp_indices
+from tile_cache import TileCache, tile_xy
+
+logger = logging.getLogger(__name__)
 
 # --- タイル情報 (クレジットはここでは表示できない) ---
+# prefetch: 表示していないタイルの先読みを許すか。OSM のタイル利用規約は先読み・一括取得を禁止しているので False
 TILE_SOURCES = {
     "osm": {
         "name": "OpenStreetMap",
         "url": "https://tile.openstreetmap.org/{z}/{x}/{y}.png",
         "attribution_text": "© OpenStreetMap contributors", # 表示できないが情報は保持
+        "prefetch": False,
     },
     "gsi_std": {
         "name": "地理院地図 標準",
         "url": "https://cyberjapandata.gsi.go.jp/xyz/std/{z}/{x}/{y}.png",
         "attribution_text": "国土地理院",
+        "prefetch": True,
     },
     "gsi_pale": {
         "name": "地理院地図 淡色",
         "url": "https://cyberjapandata.gsi.go.jp/xyz/pale/{z}/{x}/{y}.png",
         "attribution_text": "国土地理院",
+        "prefetch": True,
     },
     "gsi_photo": {
         "name": "地理院地図 航空写真",
         "url": "https://cyberjapandata.gsi.go.jp/xyz/seamlessphoto/{z}/{x}/{y}.jpg",
         "attribution_text": "国土地理院",
+        "prefetch": True,
     },
 }
+# タイルのキー -> (URL, クレジット, 表示名)。項目の欠けはここ (読み込み時) で KeyError になる
+_TILE_ENTRIES: Dict[str, tuple[str, str, str]] = {
+    key: (info["url"], info["attribution_text"], info["name"]) for key, info in TILE_SOURCES.items()
+}
+# 先読みしてよいタイルのキー (prefetch の指定がなければ先読みしない)
+_PREFETCH_KEYS = frozenset(key for key, info in TILE_SOURCES.items() if info.get("prefetch", False))
+TILE_SOURCES = MappingProxyType(TILE_SOURCES) # 実行中は変更しない (読み取り専用)
+
+# タイルのキャッシュサーバーはプロセスで1つだけ起動し、全セッションで共有する
+_tile_cache: Optional[TileCache] = None
+_tile_cache_lock = threading.Lock()
+
+def _shared_tile_cache() -> TileCache:
+    """共有のタイルキャッシュを返す (初回のみ起動する)"""
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            _tile_cache = TileCache({key: entry[0] for key, entry in _TILE_ENTRIES.items()},
+                                    prefetch_keys=_PREFETCH_KEYS)
+            _tile_cache.start()
+        return _tile_cache
 
 class MapView(ft.Container):
     """地図表示コンポーネント (flet-map==0.1.0 対応)"""
-    def __init__(self):
+    DECIMATE_MIN_POINTS: int = 4000 # これより多いトラックはポリラインを間引いて表示する
+    DECIMATE_EPSILON_M: float = 2.0 # 間引きの許容誤差の下限 (m)。直線からのずれがこれ以下の点は常に省く
+    DECIMATE_PIXEL_TOLERANCE: float = 0.5 # 現在のズームで画面上このピクセル数以下のずれは省く (広域表示ほど粗く間引く)
+    _METERS_PER_PIXEL_Z0: float = 156543.03392 # ズーム0・赤道での1ピクセルあたりの距離 (m, 256px タイル)
+    PREFETCH_ZOOM_DELTA: int = 4 # タイル切り替え時に、表示中のズームからこの段数下までの粗いタイルを先読みする
+    PREFETCH_MAX_TILES: int = 64 # 自動ズーム後にトラック全体を覆うタイルを先読みする上限枚数 (超える場合は先読みしない)
+    ZOOM_SETTLE_SEC: float = 0.25 # ホイール・ドラッグのズームがこの時間止まったら間引きを作り直す
+    # 自動ズームの対応表: 広がり(度)のしきい値 (昇順)。1つ超えるごとにズームレベルを1下げる
+    _ZOOM_SPAN_THRESHOLDS = (0.004, 0.008, 0.015, 0.03, 0.06, 0.12, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0)
+
+    def __init__(self, tile_key: Optional[str] = None, use_tile_cache: bool = True):
+        """
+        tile_key: 最初に表示するタイルのキー (TILE_SOURCES にないか None なら地理院地図 標準)
+        use_tile_cache: タイルをローカルのキャッシュサーバー (127.0.0.1) 経由で取得するか。
+            クライアントが別のマシンやブラウザで動く Web 版では 127.0.0.1 に届かないので False にする。
+        """
         super().__init__(expand=True, border_radius=ft.border_radius.all(5))
 
         self.poly_layer = fmap.PolylineLayer(polylines=[])
-        self.marker_layer = fmap.MarkerLayer(markers=[])
-        self._current_zoom: float = 5.0
+        # ハイライト用のマーカーは1つだけ作っておき、位置と表示/非表示だけを切り替える
+        self._highlight_marker = fmap.Marker(
+            content=ft.Icon(ft.Icons.LOCATION_ON, color=ft.Colors.RED_600, size=30),
+            coordinates=fmap.MapLatitudeLongitude(0, 0), width=30.0, height=30.0,
+            alignment=ft.alignment.top_center, visible=False,
+        )
+        self.marker_layer = fmap.MarkerLayer(markers=[self._highlight_marker])
+        # 地図の中心とズーム (ズームボタンはここから計算する)。初期値は地図の初期表示と同じ
+        self._current_center: fmap.MapLatitudeLongitude = fmap.MapLatitudeLongitude(35.681236, 139.767125)
+        # 地図のズーム (ホイール等では小数になる) と、それに最も近い整数のズーム段階 (1〜18)。変更は _set_zoom で両方を合わせる。
+        # 間引き・タイルの段の計算は整数の _zoom_level だけを使い、小数のズームは center_on に渡すときだけ使う
+        self._current_zoom: float = 10.0
+        self._zoom_level: int = 10
 
         # --- 初期タイルレイヤー ---
         # self.current_tile_key = "osm" # Open Street Map
-        self.current_tile_key = "gsi_std"  # 地理院地図 標準
+        self.current_tile_key = tile_key if tile_key in _TILE_ENTRIES else "gsi_std"  # 既定は地理院地図 標準
+        # デスクトップ版ではタイルをローカルのキャッシュサーバー経由で取得する (起動できなければ配信元の URL)
+        self._tile_cache: Optional[TileCache] = _shared_tile_cache() if use_tile_cache else None
         self.tile_layer = fmap.TileLayer(
-            url_template=TILE_SOURCES[self.current_tile_key]["url"],
+            url_template=self._tile_url(self.current_tile_key),
             # attribution 引数はない
         )
 
         self.map = fmap.Map(
             expand=True,
-            initial_center=fmap.MapLatitudeLongitude(35.681236, 139.767125),
-            initial_zoom=10,
+            initial_center=self._current_center,
+            initial_zoom=self._current_zoom,
             layers=[
-                self.tile_layer,
+                self.tile_layer, # 先頭 (_tile_layer_index) が一番下に表示される
                 self.poly_layer,
                 self.marker_layer,
             ],
             # options 引数はない
+            on_event=self._handle_map_event, # ホイール・ドラッグでのズームも間引きの粗さに反映する
         )
+        self._tile_layer_index: int = 0 # map.layers の中のタイルレイヤーの位置
         self.content = self.map
         self.points: List[Dict] = []
         self.current_highlight_idx: int = -1
+        # 各点の座標オブジェクト (self.points と同じ並び)。ポリラインとマーカーで使い回し、読み込み時以外は作り直さない
+        self._latlng: List[fmap.MapLatitudeLongitude] = []
+        # 緯度・経度の配列 (self.points と同じ並び、無効値は NaN)。範囲や間引きの計算は辞書ではなくこちらで行う
+        self._lat: np.ndarray = np.empty(0)
+        self._lon: np.ndarray = np.empty(0)
+        # ポリラインの座標リスト (間引いていなければ self._latlng そのもの)。削除・アンドゥでは該当する要素だけを出し入れする
+        self._coords: List[fmap.MapLatitudeLongitude] = []
+        self._decimated: bool = False # ポリラインを間引いて表示しているか
+        self._decimate_zoom: int = -1 # 表示中のポリラインを間引いたズーム段階
+        # 地図の操作イベントはフレームごとに来るので記録だけし、最後のイベントから ZOOM_SETTLE_SEC 後に1回だけ間引き直す
+        self._last_map_event: float = 0.0 # 最後に地図の操作イベントを受けた時刻 (time.monotonic)
+        self._zoom_settle_scheduled: bool = False # 間引き直しを予約済みか
+        # ズーム段階ごとの間引き結果 (残す点のインデックス)。点データの版数が変わったら破棄する
+        self._decimate_cache: Dict[int, List[int]] = {}
+        self._decimate_cache_version: int = -1
+        # 有効な座標の範囲 (min_lat, min_lon, max_lat, max_lon)。load_points で求め、点の増減で破棄する (None は未計算)
+        self._bbox: Optional[tuple[float, float, float, float]] = None
+        # 点データの版数 (読み込み・増減のたびに進める) と、ポリラインに反映済みの版数。同じならポリラインは作り直さない
+        self._points_version: int = 0
+        self._displayed_version: int = -1
+        # _suspend_updates 中は map.update() を送らず、抜けるときに1回だけ送る
+        self._updates_suspended: bool = False
+        self._update_pending: bool = False
 
     def load_points(self, points: List[Dict]):
-        self.points = points
-        self.current_highlight_idx = -1
-        self._update_map_display()
-        self._auto_zoom() # 簡易版ズームを実行
-        if points:
-            self.highlight(0)
+        with self._suspend_updates(): # ポリライン・ズーム・マーカーの変更はまとめて1回で送る
+            self.points = points
+            self.current_highlight_idx = -1
+            self._points_version += 1
+            self._latlng = self._build_latlng()
+            self._lat, self._lon = self._latlon_arrays(points) # 以降の計算は配列で行う (辞書の参照はここで1回だけ)
+            self._bbox = self._compute_bbox(self._lat, self._lon)
+            self._auto_zoom() # 簡易版ズームを実行 (間引きの粗さが決まるので先にズームを決める)
+            self._update_map_display()
+            if points:
+                self.highlight(0)
+
+    def _update_map(self):
+        """地図の変更を送る (_suspend_updates 中は抜けるときまで保留する)"""
+        if self._updates_suspended:
+            self._update_pending = True
+        elif self.map.page:
+            self.map.update()
+
+    @contextmanager
+    def _suspend_updates(self) -> Iterator[None]:
+        """with 文の中の map.update() をまとめ、抜けるときに変更があれば1回だけ送る (入れ子にしてもよい)"""
+        if self._updates_suspended:
+            yield
+            return
+        self._updates_suspended = True
+        self._update_pending = False
+        try:
+            yield
+        finally:
+            self._updates_suspended = False
+            if self._update_pending:
+                self._update_pending = False
+                self._update_map()
+
+    def _build_latlng(self) -> List[fmap.MapLatitudeLongitude]:
+        """self.points の各点の座標オブジェクトを作る"""
+        lat_lng = fmap.MapLatitudeLongitude # 点ごとのモジュール属性の参照を省く (全点を回す唯一のループ)
+        return [lat_lng(p["lat"], p["lon"]) for p in self.points]
+
+    @staticmethod
+    def _latlon_arrays(points: List[Dict]) -> tuple[np.ndarray, np.ndarray]:
+        """ポイントリストの緯度・経度を float64 の配列にする (None は NaN)"""
+        latlon = np.array([(p["lat"], p["lon"]) for p in points], dtype=np.float64).reshape(-1, 2)
+        return latlon[:, 0].copy(), latlon[:, 1].copy()
+
+    @staticmethod
+    def _compute_bbox(lat: np.ndarray, lon: np.ndarray) -> Optional[tuple[float, float, float, float]]:
+        """有効な座標の範囲 (min_lat, min_lon, max_lat, max_lon) を配列演算で求める (無効な座標 NaN は除く。なければ None)"""
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        if not valid.any():
+            return None
+        lat, lon = lat[valid], lon[valid]
+        return float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max())
 
     def _update_map_display(self):
+        """ポリラインを作り直す (点データが前回から変わっていなければ何もしない)"""
+        if self._displayed_version == self._points_version:
+            return
+        self._displayed_version = self._points_version
         if not self.points:
+            self._latlng = []
+            self._lat = self._lon = np.empty(0)
+            self._coords = []
+            self._decimated = False
             self.poly_layer.polylines = []
-            self.marker_layer.markers = []
-            if self.map.page: self.map.update()
+            self._highlight_marker.visible = False
+            self._update_map()
             return
 
-        coords = [fmap.MapLatitudeLongitude(p["lat"], p["lon"]) for p in self.points]
+        self._decimated = len(self.points) > self.DECIMATE_MIN_POINTS
+        if self._decimated:
+            # 点の多いトラックは見た目が変わらない範囲で頂点を減らし、送信量と描画量を抑える (編集用のデータは全点のまま)
+            coords = self._decimated_coords()
+        else:
+            coords = self._latlng # 座標オブジェクトのリストをそのまま渡す
+        self._coords = coords
         self.poly_layer.polylines = [
             fmap.PolylineMarker(
                 coordinates=coords,
@@ -84,33 +236,87 @@ class MapView(ft.Container):
                 border_color=ft.Colors.BLUE_700,
             )
         ]
-        self.marker_layer.markers = [] # マーカーはhighlightで
-        if self.map.page: self.map.update()
+        self._highlight_marker.visible = False # マーカーはhighlightで
+        self._update_map()
+
+    def _zoom_bucket(self) -> int:
+        """間引きの粗さや先読みするタイルの段を決める整数のズーム段階 (現在のズームに最も近い整数、1〜18)"""
+        return self._zoom_level
+
+    def _set_zoom(self, zoom: float):
+        """地図のズームを記録し、整数のズーム段階もここで1回だけ求めておく"""
+        self._current_zoom = zoom
+        self._zoom_level = min(max(round(zoom), 1), 18)
+
+    def _decimated_coords(self) -> List[fmap.MapLatitudeLongitude]:
+        """現在のズーム段階に合わせて間引いたポリラインの座標リストを返す (段階ごとの結果は版数が変わるまで使い回す)"""
+        if self._decimate_cache_version != self._points_version:
+            self._decimate_cache = {}
+            self._decimate_cache_version = self._points_version
+        bucket = self._zoom_bucket()
+        kept = self._decimate_cache.get(bucket)
+        if kept is None:
+            # 許容誤差は画面上 DECIMATE_PIXEL_TOLERANCE ピクセル相当 (ただし DECIMATE_EPSILON_M 以上)
+            epsilon = max(self.DECIMATE_EPSILON_M,
+                          self._METERS_PER_PIXEL_Z0 / 2 ** bucket * self.DECIMATE_PIXEL_TOLERANCE)
+            kept = rdp_indices(self._lat, self._lon, epsilon).tolist()
+            self._decimate_cache[bucket] = kept
+            logger.debug("_decimated_coords: ポリラインを間引き (zoom=%d, %.1fm) %d -> %d 点",
+                         bucket, epsilon, len(self.points), len(kept))
+        self._decimate_zoom = bucket
+        latlng = self._latlng
+        return [latlng[i] for i in kept]
+
+    def _on_zoom_changed(self):
+        """ズーム段階が変わったら、間引いて表示しているポリラインをその段階の粗さで作り直す"""
+        if not self._decimated or not self.poly_layer.polylines or self._zoom_bucket() == self._decimate_zoom \
+                or self._displayed_version != self._points_version:
+            return
+        self._coords = self._decimated_coords()
+        self.poly_layer.polylines[0].coordinates = self._coords
+        self._update_map()
 
-    def _get_zoom_level(self, span: float) -> float:
+    def _handle_map_event(self, e: fmap.MapEvent):
+        """
+        地図の操作 (ホイール・ドラッグ等) で変わった中心とズームを記録する (ズームボタンは移動後の中心から拡大・縮小する)。
+        ホイール等のズームは小数のまま持つ (丸めるとズームボタンで段が飛んだり、押しても変わらなかったりする)。
+        操作中はフレームごとに呼ばれるので、ここでは記録だけして間引き直しは操作が止まってから行う。
+        """
+        if e.center.latitude is not None and e.center.longitude is not None:
+            self._current_center = e.center
+        if e.zoom is None:
+            return
+        self._set_zoom(e.zoom)
+        self._last_map_event = time.monotonic()
+        if not self._decimated or self._zoom_bucket() == self._decimate_zoom or self._zoom_settle_scheduled:
+            return
+        if self.page is None:
+            self._on_zoom_changed()
+            return
+        self._zoom_settle_scheduled = True
+        self.page.run_task(self._settle_zoom)
+
+    async def _settle_zoom(self):
+        """地図の操作が ZOOM_SETTLE_SEC 止まるまで待ち、その時点のズーム段階でポリラインを間引き直す"""
+        while True:
+            await asyncio.sleep(self.ZOOM_SETTLE_SEC)
+            if time.monotonic() - self._last_map_event >= self.ZOOM_SETTLE_SEC:
+                break
+        self._zoom_settle_scheduled = False
+        self._on_zoom_changed() # 操作中に元の段階へ戻っていれば何もしない
+
+    def _get_zoom_level(self, span: float) -> int:
         """地理的な広がり(度)から簡易的にズームレベルを推定するヘルパー関数"""
-        # この対応表は調整の余地あり
-        if span == 0: return 18.0
-        if span < 0.004: return 17.0 # より細かく
-        if span < 0.008: return 16.0
-        if span < 0.015: return 15.0
-        if span < 0.03: return 14.0
-        if span < 0.06: return 13.0
-        if span < 0.12: return 12.0
-        if span < 0.25: return 11.0
-        if span < 0.5: return 10.0
-        if span < 1.0: return 9.0
-        if span < 2.0: return 8.0
-        if span < 4.0: return 7.0
-        if span < 8.0: return 6.0
-        if span < 15.0: return 5.0
-        if span < 30.0: return 4.0
-        return 3.0 # それ以上はZoom 3
-    
+        # この対応表は調整の余地あり: span がしきい値 _ZOOM_SPAN_THRESHOLDS[i] 未満となる最初の i でズーム 17 - i
+        # (0.004度未満でズーム17、30度以上はズーム3)
+        if span == 0: return 18
+        return 17 - bisect_right(self._ZOOM_SPAN_THRESHOLDS, span)
+
     def _auto_zoom(self):
         """
         軌跡全体が画面に収まるように中心とズームを計算し、
         少し余裕を持たせたズームレベルを設定する。
+        座標の範囲は load_points で求めた self._bbox を使う。
         """
         if not self.points: return  # ポイントなければ終了
 
@@ -121,10 +327,15 @@ class MapView(ft.Container):
         if len(self.points) == 1:
             p = self.points[0]
             center = fmap.MapLatitudeLongitude(p["lat"], p["lon"])
-            new_zoom = 15.0 # 1点の場合は固定
+            new_zoom = 15 # 1点の場合は固定
         elif len(self.points) > 1:  # ポイントが2つ以上の場合のみ計算
-            lats = [p["lat"] for p in self.points]; lons = [p["lon"] for p in self.points]
-            min_lat, max_lat = min(lats), max(lats); min_lon, max_lon = min(lons), max(lons)
+            # 緯度・経度の最小・最大 (点が増減した後なら求め直す)
+            if self._bbox is None:
+                self._bbox = self._compute_bbox(self._lat, self._lon)
+            if self._bbox is None:
+                logger.warning("_auto_zoom: No valid coordinates to calculate zoom.")
+                return
+            min_lat, min_lon, max_lat, max_lon = self._bbox
 
             # 中心座標を計算
             center_lat = (max_lat + min_lat) / 2
@@ -135,142 +346,223 @@ class MapView(ft.Container):
             lat_span = max_lat - min_lat
             lon_span = max_lon - min_lon
 
-            # --- ★★★ 緯度/経度の広がりそれぞれに必要なズームレベルを計算 ★★★ ---
-            # ヘルパー関数を使って、各spanを収めるのに必要なズームレベルを推定
-            zoom_for_lat = self._get_zoom_level(lat_span)
-            zoom_for_lon = self._get_zoom_level(lon_span)
-
-            # --- ★★★ より小さいズームレベルを採用（広い範囲を表示） ★★★ ---
+            # --- ★★★ 広い方の広がりが収まるズームレベルを採用 ★★★ ---
             # 緯度も経度も両方画面に収めるには、より広域を表示するズームレベルを選ぶ必要がある
-            base_zoom = min(zoom_for_lat, zoom_for_lon)
+            # (_get_zoom_level は広がりについて単調減少なので、各軸のズームの min は広い方の広がりのズームと同じ)
+            base_zoom = self._get_zoom_level(max(lat_span, lon_span))
 
             # --- ★★★ さらにマージンとしてズームレベルを1段階下げる ★★★ ---
             # これが「1.2倍大きく枠をとる」に近い効果を狙う調整
-            adjusted_zoom = max(base_zoom - 1.0, 1.0) # 最小ズームは1
+            adjusted_zoom = max(base_zoom - 1, 1) # 最小ズームは1
             new_zoom = adjusted_zoom
 
-            print(f"[DEBUG] _auto_zoom: lat_span={lat_span:.4f}(zoom={zoom_for_lat}), lon_span={lon_span:.4f}(zoom={zoom_for_lon}) -> base_zoom={base_zoom}, adjusted_zoom={new_zoom}")
+            logger.debug("_auto_zoom: lat_span=%.4f, lon_span=%.4f -> base_zoom=%d, adjusted_zoom=%d",
+                         lat_span, lon_span, base_zoom, new_zoom)
         else:
             # ポイントが0個の場合
-            print("[WARN] _auto_zoom: No points to calculate zoom.")
+            logger.warning("_auto_zoom: No points to calculate zoom.")
             # この場合、中心やズームは変更しない（初期表示のまま）
             return            
 
         # 最終的な中心とズームで地図を設定
         self._current_center = center
-        self._current_zoom = new_zoom
+        self._set_zoom(float(new_zoom))
         self.map.center_on(self._current_center, zoom=self._current_zoom) # 地図に設定
-        if self.map.page: self.map.update()
+        self._on_zoom_changed()
+        self._prefetch_track_tiles()
+        self._update_map()
 
     def highlight(self, idx: int):
         self.current_highlight_idx = idx
+        marker = self._highlight_marker
         if not (0 <= idx < len(self.points)):
-            self.marker_layer.markers = []
-            if self.map.page: self.map.update()
+            if marker.visible:
+                marker.visible = False
+                self._update_map()
             return
 
-        p = self.points[idx]
-        loc = fmap.MapLatitudeLongitude(p["lat"], p["lon"])
+        loc = self._latlng[idx] # ポリラインと同じ座標オブジェクトを使う (新しく作らない)
 
-        if not self.marker_layer.markers:
-            self.marker_layer.markers = [
-                fmap.Marker(
-                    content=ft.Icon(ft.Icons.LOCATION_ON, color=ft.Colors.RED_600, size=30),
-                    coordinates=loc, width=30.0, height=30.0, alignment=ft.alignment.top_center,
-                )
-            ]
-        else:
-            self.marker_layer.markers[0].coordinates = loc
+        if marker.visible and marker.coordinates is loc:
+            return # マーカーは既にこの点にあるので送り直さない
+        marker.coordinates = loc
+        marker.visible = True
 
         # self.map.center_on(loc, zoom=None)
-        if self.map.page: self.map.update()
+        self._update_map()
 
     def change_tile_layer(self, tile_key: str):
-        """タイルレイヤーを新しいオブジェクトに差し替える。"""
-        if tile_key not in TILE_SOURCES or tile_key == self.current_tile_key:
+        """
+        タイルレイヤーを新しいオブジェクトに差し替える。
+        最初に表示するタイルはコンストラクタの tile_key で渡すので、これは配置後の切り替えで呼ばれる
+        (配置前なら layers の差し替えだけで、更新は送られない)。
+        """
+        entry = _TILE_ENTRIES.get(tile_key)
+        if entry is None or tile_key == self.current_tile_key:
             # キーが無効か、現在と同じなら何もしない
             return
 
-        new_tile_info = TILE_SOURCES[tile_key]
-        print(f"タイルレイヤー変更試行: {new_tile_info['name']}")
-
+        logger.debug("タイルレイヤー変更試行: %s", entry[2])
+        self.current_tile_key = tile_key
         try:
-            # 1. 現在のタイルレイヤー (self.tile_layer) を layers リストから削除
-            #    存在確認をしてから削除する
-            if self.tile_layer in self.map.layers:
-                print(f"  - Removing old tile layer: {self.tile_layer.url_template}")
-                self.map.layers.remove(self.tile_layer)
-            else:
-                # self.tile_layer が見つからない場合 (念のため他のTileLayerも探す)
-                print("  - WARN: self.tile_layer not found directly in map.layers. Searching...")
-                found_and_removed = False
-                for i, layer in enumerate(list(self.map.layers)): # リストのコピーでループ
-                    if isinstance(layer, fmap.TileLayer):
-                        print(f"  - Found TileLayer at index {i}, removing it.")
-                        self.map.layers.pop(i) # インデックスで削除
-                        found_and_removed = True
-                        break
-                if not found_and_removed:
-                    print("  - ERROR: No TileLayer found to remove.")
-                    # return # 続行不能かもしれないが、新しいレイヤー追加は試みる
-
-            # 2. 新しい TileLayer オブジェクトを作成
+            # 1. 新しい TileLayer オブジェクトを作成
             new_tile_layer = fmap.TileLayer(
-                url_template=new_tile_info["url"],
+                url_template=self._tile_url(tile_key), # 取得済みのタイルはキャッシュから
                 # attribution は設定できない
             )
-            print(f"  - Creating new tile layer: {new_tile_layer.url_template}")
+            logger.debug("  - Creating new tile layer: %s", new_tile_layer.url_template)
 
-            # 3. 新しいレイヤーを layers リストの先頭 (インデックス 0) に挿入
-            #    ※ layers[0] が一番下に表示されるレイヤー
-            self.map.layers.insert(0, new_tile_layer)
-            print(f"  - Inserted new layer at index 0. Total layers: {len(self.map.layers)}")
+            # 2. layers リストの同じ位置 (一番下に表示される先頭) の古いレイヤーと置き換える
+            self.map.layers[self._tile_layer_index] = new_tile_layer
+            logger.debug("  - Replaced tile layer at index %d. Total layers: %d", self._tile_layer_index, len(self.map.layers))
 
-            # 4. self.tile_layer と self.current_tile_key を更新
+            # 3. self.tile_layer を更新
             self.tile_layer = new_tile_layer # 新しいインスタンスを保持
-            self.current_tile_key = tile_key
+            self._prefetch_coarse_tiles()
 
-            # 5. 地図の更新を要求
-            if self.map.page:
-                print("  - Calling map.update()")
-                self.map.update()
-            else:
-                print("  - Map not attached to page, skipping update.")
+            # 4. 地図の更新を要求
+            self._update_map()
 
         except Exception as e:
-            print(f"[ERROR] タイルレイヤー変更中にエラーが発生しました: {e}")
-            traceback.print_exc()
+            logger.exception("タイルレイヤー変更中にエラーが発生しました: %s", e)
+
+    def _tile_url(self, tile_key: str) -> str:
+        """TileLayer に渡す URL テンプレート (キャッシュを使わなければ配信元の URL)"""
+        if self._tile_cache is None:
+            return _TILE_ENTRIES[tile_key][0]
+        return self._tile_cache.url_template(tile_key)
+
+    def _prefetch_coarse_tiles(self):
+        """
+        現在の中心付近の粗いズーム (表示中のズームの PREFETCH_ZOOM_DELTA 段下まで) のタイルを
+        キャッシュに先読みする。切り替え直後に縮小しても、少ない枚数の粗いタイルはすぐに表示できる。
+        """
+        if self._tile_cache is None or self.current_tile_key not in _PREFETCH_KEYS:
+            return
+        center = self._current_center
+        zoom = self._zoom_bucket()
+        tiles = []
+        for z in range(max(zoom - self.PREFETCH_ZOOM_DELTA, 1), zoom):
+            n = 1 << z
+            cx, cy = tile_xy(center.latitude, center.longitude, z)
+            # 中心のタイルと周囲1枚ずつ (x は経度180度で折り返す)
+            tiles.extend((z, x % n, y) for y in range(max(cy - 1, 0), min(cy + 2, n)) for x in range(cx - 1, cx + 2))
+        self._tile_cache.prefetch(self.current_tile_key, dict.fromkeys(tiles))
+
+    def _prefetch_track_tiles(self):
+        """自動ズーム後のズームでトラックの範囲を覆うタイルをキャッシュに並行して先読みする"""
+        if self._tile_cache is None or self._bbox is None or self.current_tile_key not in _PREFETCH_KEYS:
+            return
+        min_lat, min_lon, max_lat, max_lon = self._bbox
+        zoom = self._zoom_bucket()
+        # タイルの y は北ほど小さい
+        x0, y0 = tile_xy(max_lat, min_lon, zoom)
+        x1, y1 = tile_xy(min_lat, max_lon, zoom)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > self.PREFETCH_MAX_TILES:
+            return
+        self._tile_cache.prefetch(self.current_tile_key,
+                                  [(zoom, x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)])
 
     def get_current_tile_attribution(self) -> str:
         """現在のタイルソースのクレジット文字列を返す"""
-        return TILE_SOURCES.get(self.current_tile_key, {}).get("attribution_text", "")
+        return _TILE_ENTRIES[self.current_tile_key][1] # current_tile_key は常に有効なキー
 
-    def zoom_in(self):
-        """地図を1段階ズームインする（中心は維持）"""
-        max_zoom = 18
+    def zoom_in(self, e: Optional[ft.ControlEvent] = None):
+        """地図を1段階ズームインする（中心は維持）。ボタンの on_click に直接渡せるようイベント引数を受け取る"""
+        max_zoom = 18.0
         new_zoom = min(self._current_zoom + 1, max_zoom)
         if new_zoom != self._current_zoom:
-            print(f"Zooming in to: {new_zoom}")
-            self._current_zoom = new_zoom # 内部状態更新
+            logger.debug("Zooming in to: %.1f", new_zoom)
+            self._set_zoom(new_zoom) # 内部状態更新
             # ★ 現在の中心座標(_current_center)と新しいズームレベルでcenter_onを呼ぶ ★
             self.map.center_on(self._current_center, zoom=self._current_zoom)
-            if self.map.page: self.map.update()
-        else: print(f"Already at max zoom ({max_zoom})")
-
-    def zoom_out(self):
-        """地図を1段階ズームアウトする（中心は維持）"""
-        min_zoom = 1
+            with self._suspend_updates(): # 間引き直したポリラインと合わせて1回で送る
+                self._on_zoom_changed()
+                self._update_map()
+        else: logger.debug("Already at max zoom (%d)", max_zoom)
+
+    def zoom_out(self, e: Optional[ft.ControlEvent] = None):
+        """地図を1段階ズームアウトする（中心は維持）。ボタンの on_click に直接渡せるようイベント引数を受け取る"""
+        min_zoom = 1.0
         new_zoom = max(self._current_zoom - 1, min_zoom)
         if new_zoom != self._current_zoom:
-            print(f"Zooming out to: {new_zoom}")
-            self._current_zoom = new_zoom # 内部状態更新
+            logger.debug("Zooming out to: %.1f", new_zoom)
+            self._set_zoom(new_zoom) # 内部状態更新
             # ★ 現在の中心座標(_current_center)と新しいズームレベルでcenter_onを呼ぶ ★
             self.map.center_on(self._current_center, zoom=self._current_zoom)
-            if self.map.page: self.map.update()
-        else: print(f"Already at min zoom ({min_zoom})")
+            with self._suspend_updates(): # 間引き直したポリラインと合わせて1回で送る
+                self._on_zoom_changed()
+                self._update_map()
+        else: logger.debug("Already at min zoom (%d)", min_zoom)
 
     def refresh(self):
-        """データ変更時にポリラインとハイライトを更新"""
-        self._update_map_display()
-        if self.points and self.current_highlight_idx >= 0:
-            self.highlight(self.current_highlight_idx)
+        """データ変更時にポリラインとハイライトを更新 (座標が変わっていなければポリラインは作り直さない)"""
+        lat, lon = self._latlon_arrays(self.points)
+        if not (np.array_equal(lat, self._lat, equal_nan=True) and np.array_equal(lon, self._lon, equal_nan=True)):
+            self._points_version += 1
+            self._bbox = None
+            self._latlng = self._build_latlng() # self.points が入れ替わっていてもよいように作り直す
+            self._lat, self._lon = lat, lon
+        with self._suspend_updates(): # ポリラインとマーカーの変更はまとめて1回で送る
+            self._update_map_display()
+            if self.points and self.current_highlight_idx >= 0:
+                self.highlight(self.current_highlight_idx)
+
+    def apply_delta(self, change: Dict):
+        """
+        削除・アンドゥで変わった点だけをポリラインの座標リストに反映する (全座標は作り直さない)。
+        change は {"op": "delete"|"insert", "indices": [...]} (delete は削除前の位置、insert は挿入後の位置。昇順)。
+        ハイライトは呼び出し元で設定し直す。
+        """
+        op = change.get("op")
+        indices: List[int] = change.get("indices") or []
+        self._bbox = None # 点が増減したので範囲は次に必要になったときに求め直す
+        self._points_version += 1
+        latlng = self._latlng
+        if indices:
+            contiguous = indices[-1] - indices[0] == len(indices) - 1
+            if op == "delete":
+                if contiguous:
+                    del latlng[indices[0]:indices[-1] + 1]
+                else:
+                    drop = set(indices)
+                    latlng[:] = [c for i, c in enumerate(latlng) if i not in drop]
+            elif op == "insert":
+                lat_lng, points = fmap.MapLatitudeLongitude, self.points
+                new_coords = [lat_lng(p["lat"], p["lon"]) for p in map(points.__getitem__, indices)]
+                if contiguous:
+                    latlng[indices[0]:indices[0]] = new_coords
+                else:
+                    # 飛び飛びの位置は1件ずつ insert せず、挿入後の位置に置きながら既存の要素で間を埋めた併合リストを
+                    # 1回の走査で作って中身を差し替える (ポリラインが同じリストを参照しているので入れ物は変えない)
+                    merged: List[fmap.MapLatitudeLongitude] = []
+                    pos = 0
+                    for new_idx, c in zip(indices, new_coords):
+                        take = new_idx - len(merged)
+                        merged.extend(latlng[pos:pos + take])
+                        pos += take
+                        merged.append(c)
+                    merged.extend(latlng[pos:])
+                    latlng[:] = merged
+            # 緯度・経度の配列も同じ位置を出し入れする (np.insert の位置は挿入前の配列基準なので k 番目から k を引く)
+            if op == "delete":
+                drop = np.asarray(indices, dtype=np.intp)
+                self._lat, self._lon = np.delete(self._lat, drop), np.delete(self._lon, drop)
+            elif op == "insert":
+                before = np.asarray(indices, dtype=np.intp) - np.arange(len(indices))
+                lat, lon = self._latlon_arrays([self.points[i] for i in indices])
+                self._lat, self._lon = np.insert(self._lat, before, lat), np.insert(self._lon, before, lon)
+        if len(latlng) != len(self.points) or len(self._lat) != len(self.points):
+            # 想定外の変更 (件数の不一致) は作り直す
+            self._latlng = self._build_latlng()
+            self._lat, self._lon = self._latlon_arrays(self.points)
+            self._update_map_display()
+            return
+        if not self.poly_layer.polylines or not self.points or self._decimated \
+                or len(self.points) > self.DECIMATE_MIN_POINTS:
+            # ポリラインがない (空から復元した等)・全削除、または間引いて表示する場合は作り直す
+            self._update_map_display()
+            return
+        # 間引いていなければポリラインの座標リストは self._latlng そのものなので、上の出し入れで反映済み
+        self._displayed_version = self._points_version
+        self._update_map()
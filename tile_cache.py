@@ -0,0 +1,355 @@
+"""
+gpxhandle/tile_cache.py
+
+地図タイルのローカルキャッシュ
+- 127.0.0.1 で小さな HTTP サーバーを動かし、TileLayer の url_template をこのサーバーに向ける
+- 取得済みのタイルはディスクに保存し、タイルの切り替えや再表示ではネットワークに取りに行かない
+- 最近使ったタイルはメモリにも置き、移動・ズームで再表示するときはディスクも読まない
+- 配信元の Cache-Control / Expires に従って有効期限を保存し、期限を過ぎたタイルは取り直す
+- 127.0.0.1 は Python と同じマシンで動くクライアント (デスクトップ版) からしか見えないので、Web 版では使わない
+"""
+
+import http.client
+import logging
+import math
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# キャッシュの保存先と上限サイズ (超えた分は起動時に古いものから削除)
+CACHE_DIR = Path.home() / ".gpxhandle" / "tiles"
+MAX_CACHE_BYTES = 500 * 1024 * 1024
+MEMORY_CACHE_BYTES = 64 * 1024 * 1024 # メモリに置くタイルの上限 (超えたら最後に使ったのが古いものから捨てる)
+FETCH_TIMEOUT_SEC = 10
+DEFAULT_MAX_AGE_SEC = 24 * 60 * 60 # 配信元が有効期限を示さない場合の有効期間
+PREFETCH_WORKERS = 2 # 先読みで同時に取得するタイルの数 (配信元への接続数を抑える)
+MISSING_TILE_SEC = 10 * 60 # 配信元にない (4xx) タイルを取りに行かない期間 (範囲外の地域を移動するたびに問い合わせない)
+MISSING_TILE_ENTRIES = 4096 # 配信元にないタイルを覚えておく上限 (超えたら古いものから忘れる)
+MAX_ZOOM = 19 # 受け付けるズームの上限
+# タイル配信元の利用規約に従い、アプリを識別できる User-Agent を付ける
+USER_AGENT = "gpxhandle (+https://github.com/sakikimi/gpxhandle)"
+
+_CONTENT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+_MAX_LATITUDE = 85.0511287798 # Web メルカトルで表示できる緯度の上限
+_EXPIRES_SUFFIX = ".expires" # タイルと並べて置く有効期限ファイル (UNIX 時間) の拡張子
+# 配信元からの取得で起こりうる例外 (タイムアウト・HTTP エラーは OSError、途中で切れた応答などは HTTPException)
+_FETCH_ERRORS = (OSError, http.client.HTTPException)
+
+
+class TileNotFoundError(OSError):
+    """配信元にタイルがない (4xx)。MISSING_TILE_SEC の間は同じタイルを取りに行かない"""
+
+
+def _expiry_from_headers(headers: Message, now: float) -> float:
+    """配信元のレスポンスヘッダーからタイルの有効期限 (UNIX 時間) を求める。Cache-Control を Expires より優先する。"""
+    for directive in (headers.get("Cache-Control") or "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name in ("no-cache", "no-store"):
+            return now # 保存はするが、次に使うときは取り直す
+        if name == "max-age":
+            try:
+                return now + max(int(value.strip('" ')), 0)
+            except ValueError:
+                break
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            return now # 不正な Expires は期限切れとして扱う (RFC 9111)
+    return now + DEFAULT_MAX_AGE_SEC
+
+
+def tile_xy(lat: float, lon: float, zoom: int) -> Tuple[int, int]:
+    """緯度経度を含むタイルの番号 (x, y) を返す (Web メルカトル、いわゆる slippy map の式)"""
+    n = 1 << zoom
+    lat_r = math.radians(min(max(lat, -_MAX_LATITUDE), _MAX_LATITUDE))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat_r)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+class TileCache:
+    """
+    タイルのキャッシュサーバー。
+    /{タイルのキー}/{z}/{x}/{y} へのリクエストを、ディスクにあればそこから、なければ配信元から取得して返す。
+    """
+
+    def __init__(self, sources: Dict[str, str], cache_dir: Path = CACHE_DIR,
+                 max_bytes: int = MAX_CACHE_BYTES, memory_bytes: int = MEMORY_CACHE_BYTES,
+                 prefetch_keys: Iterable[str] = ()):
+        """
+        Args:
+            sources (Dict[str, str]): タイルのキーと配信元の URL テンプレート ({z}/{x}/{y} を含む)。
+            cache_dir (Path): キャッシュの保存先。
+            max_bytes (int): キャッシュの上限サイズ (バイト)。
+            memory_bytes (int): メモリに置くタイルの上限サイズ (バイト)。0 ならメモリには置かない。
+            prefetch_keys (Iterable[str]): 先読みを許すタイルのキー。配信元の利用規約で先読みが禁止されているものは含めない。
+        """
+        self.sources = dict(sources)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.prefetch_keys = frozenset(prefetch_keys)
+        self._server: Optional[ThreadingHTTPServer] = None
+        # (キー, z, x, y) -> (タイルのデータ, 有効期限)。最後に使ったものほど後ろ (LRU)。リクエストは複数スレッドで処理するのでロックで守る
+        self._memory: "OrderedDict[Tuple[str, int, int, int], Tuple[bytes, float]]" = OrderedDict()
+        self._memory_size = 0
+        self._memory_lock = threading.Lock()
+        # 取得中のタイル -> 取得完了の通知。地図と先読みが同じタイルを同時に要求しても配信元へは1回だけ取りに行く
+        self._inflight: Dict[Tuple[str, int, int, int], threading.Event] = {}
+        self._inflight_lock = threading.Lock()
+        self._prefetching: set = set() # 先読み中のタイルのキー (同じキーの先読みは重ねない)
+        # 配信元にないタイル -> (HTTP ステータス, 再び取りに行ける時刻)。古いものほど前 (_memory_lock で守る)
+        self._missing: "OrderedDict[Tuple[str, int, int, int], Tuple[int, float]]" = OrderedDict()
+
+    def start(self) -> bool:
+        """サーバーを別スレッドで起動する。起動できなければ False (配信元の URL をそのまま使う)。"""
+        if self._server is not None:
+            return True
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            handler = type("TileRequestHandler", (_TileRequestHandler,), {"cache": self})
+            self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler) # 空いているポートを使う
+        except OSError as e:
+            logger.warning("タイルキャッシュを起動できません。配信元から直接取得します: %s", e)
+            self._server = None
+            return False
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="tile-cache", daemon=True).start()
+        # 上限を超えた古いタイルの削除は表示を待たせないよう別スレッドで行う
+        threading.Thread(target=self.prune, name="tile-cache-prune", daemon=True).start()
+        logger.debug("タイルキャッシュ起動: port=%d, dir=%s", self._server.server_port, self.cache_dir)
+        return True
+
+    def url_template(self, key: str) -> str:
+        """TileLayer に渡す URL テンプレートを返す (サーバーが動いていなければ配信元の URL)。"""
+        if self._server is None:
+            return self.sources[key]
+        return f"http://127.0.0.1:{self._server.server_port}/{key}/{{z}}/{{x}}/{{y}}"
+
+    def tile_path(self, key: str, z: int, x: int, y: int) -> Path:
+        """タイル1枚の保存先。拡張子は配信元の URL に合わせる。"""
+        ext = os.path.splitext(self.sources[key])[1] or ".png"
+        return self.cache_dir / key / str(z) / str(x) / f"{y}{ext}"
+
+    def get_tile(self, key: str, z: int, x: int, y: int) -> Tuple[bytes, float]:
+        """
+        タイルとその有効期限 (UNIX 時間) をキャッシュ (メモリ、ディスクの順) から返す。
+        なければ、または期限切れなら配信元から取得して保存する。取り直せなければ期限切れのタイルを返す。
+        配信元にないタイルは TileNotFoundError、取得できなければ OSError か http.client.HTTPException を送出する。
+        """
+        tile_id = (key, z, x, y)
+        now = time.time()
+        with self._memory_lock:
+            cached = self._memory.get(tile_id)
+            if cached is not None and cached[1] > now:
+                self._memory.move_to_end(tile_id)
+                return cached
+        path = self.tile_path(key, z, x, y)
+        stale = cached or self._read(path)
+        if stale is not None and stale[1] > now:
+            self._remember(tile_id, stale)
+            return stale
+        try:
+            tile = self._download_once(tile_id, path)
+        except _FETCH_ERRORS as e:
+            if stale is None:
+                raise
+            logger.debug("タイル再取得失敗のため期限切れを使用 %s/%d/%d/%d: %s", key, z, x, y, e)
+            return stale[0], now
+        self._remember(tile_id, tile)
+        return tile
+
+    @staticmethod
+    def _read(path: Path) -> Optional[Tuple[bytes, float]]:
+        """ディスクのタイルと有効期限を読む (なければ None)。期限ファイルがなければ保存時刻から既定の期間とする。"""
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        expires_path = path.with_name(path.name + _EXPIRES_SUFFIX)
+        try:
+            expires = float(expires_path.read_text())
+        except (OSError, ValueError):
+            try:
+                expires = path.stat().st_mtime + DEFAULT_MAX_AGE_SEC
+            except OSError:
+                expires = 0.0
+        return data, expires
+
+    def _download_once(self, tile_id: Tuple[str, int, int, int], path: Path) -> Tuple[bytes, float]:
+        """同じタイルを別のスレッドが取得中ならその完了を待って保存済みのものを読み、そうでなければ取得する。"""
+        with self._inflight_lock:
+            done = self._inflight.get(tile_id)
+            if done is None:
+                self._inflight[tile_id] = threading.Event()
+        if done is not None:
+            done.wait(FETCH_TIMEOUT_SEC)
+            tile = self._read(path)
+            if tile is not None and tile[1] > time.time():
+                return tile
+            return self._download(*tile_id, path) # 先に取得していた側が失敗した場合は自分で取りに行く
+        try:
+            return self._download(*tile_id, path)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(tile_id).set()
+
+    def _download(self, key: str, z: int, x: int, y: int, path: Path) -> Tuple[bytes, float]:
+        """タイルを配信元から取得し、有効期限と合わせてディスクに保存する。配信元にないタイルはしばらく覚えておく。"""
+        tile_id = (key, z, x, y)
+        with self._memory_lock:
+            missing = self._missing.get(tile_id)
+        if missing is not None and missing[1] > time.time():
+            raise TileNotFoundError(f"HTTP {missing[0]} (cached)")
+        url = self.sources[key].format(z=z, x=x, y=y)
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+        try:
+            with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT_SEC) as response:
+                data = response.read()
+                expires = _expiry_from_headers(response.headers, time.time())
+        except urllib.error.HTTPError as e:
+            if not 400 <= e.code < 500:
+                raise
+            with self._memory_lock:
+                self._missing.pop(tile_id, None)
+                self._missing[tile_id] = (e.code, time.time() + MISSING_TILE_SEC)
+                while len(self._missing) > MISSING_TILE_ENTRIES:
+                    self._missing.popitem(last=False)
+            raise TileNotFoundError(f"HTTP {e.code}") from e
+        # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for target, content in ((path, data), (path.with_name(path.name + _EXPIRES_SUFFIX), repr(expires).encode())):
+            tmp = target.with_name(f"{target.name}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(content)
+            os.replace(tmp, target)
+        return data, expires
+
+    def _remember(self, tile_id: Tuple[str, int, int, int], tile: Tuple[bytes, float]):
+        """タイルをメモリに置き、上限を超えたら最後に使ったのが古いものから捨てる。"""
+        size = len(tile[0])
+        if size > self.memory_bytes:
+            return
+        with self._memory_lock:
+            old = self._memory.pop(tile_id, None)
+            if old is not None:
+                self._memory_size -= len(old[0])
+            self._memory[tile_id] = tile
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, (evicted, _) = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def prefetch(self, key: str, tiles: Iterable[Tuple[int, int, int]]):
+        """
+        タイル (z, x, y) を別スレッドで取得してディスクに保存しておく (保存済みのものは飛ばす)。
+        サーバーが動いていなければ地図は配信元から直接取得するので何もしない。先読みを許していないキーも何もしない。
+        同じキーの先読みがまだ終わっていなければ、新しい要求は捨てる (タイルの切り替えを繰り返しても取得が積み重ならない)。
+        """
+        if self._server is None or key not in self.prefetch_keys:
+            return
+        with self._inflight_lock:
+            if key in self._prefetching:
+                logger.debug("タイル先読み %s: 前回の先読み中のため省略", key)
+                return
+            self._prefetching.add(key)
+        tiles = list(tiles)
+        threading.Thread(target=self._prefetch, args=(key, tiles), name="tile-cache-prefetch", daemon=True).start()
+
+    def _prefetch(self, key: str, tiles: list):
+        """未保存のタイルを PREFETCH_WORKERS 本のスレッドで並行して取得する (通信待ちを重ねる)"""
+        try:
+            missing = [tile for tile in tiles if not self.tile_path(key, *tile).exists()]
+            if not missing:
+                return
+            with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="tile-cache-prefetch") as pool:
+                fetched = sum(pool.map(lambda tile: self._prefetch_one(key, *tile), missing))
+            logger.debug("タイル先読み %s: %d / %d 件取得", key, fetched, len(missing))
+        finally:
+            with self._inflight_lock:
+                self._prefetching.discard(key)
+
+    def _prefetch_one(self, key: str, z: int, x: int, y: int) -> bool:
+        try:
+            self.get_tile(key, z, x, y)
+        except _FETCH_ERRORS as e:
+            logger.debug("タイル先読み失敗 %s/%d/%d/%d: %s", key, z, x, y, e)
+            return False
+        return True
+
+    def prune(self):
+        """キャッシュの合計サイズが上限を超えていれば、最終更新の古いタイルから (有効期限ファイルごと) 削除する。"""
+        try:
+            files = [(entry.stat(), entry) for entry in self.cache_dir.rglob("*")
+                     if entry.is_file() and entry.suffix != _EXPIRES_SUFFIX]
+        except OSError as e:
+            logger.warning("タイルキャッシュの確認に失敗しました: %s", e)
+            return
+        total = sum(st.st_size for st, _ in files)
+        if total <= self.max_bytes:
+            return
+        removed = 0
+        for st, entry in sorted(files, key=lambda f: f[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+                entry.with_name(entry.name + _EXPIRES_SUFFIX).unlink(missing_ok=True)
+            except OSError:
+                continue
+            total -= st.st_size
+            removed += 1
+        logger.debug("タイルキャッシュ整理: %d 件削除", removed)
+
+
+class _TileRequestHandler(BaseHTTPRequestHandler):
+    """/{キー}/{z}/{x}/{y} のリクエストを TileCache に渡すハンドラー"""
+    cache: TileCache
+
+    def do_GET(self):
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        try:
+            key, z, x, y = parts[0], int(parts[1]), int(parts[2]), int(parts[3])
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+        if key not in self.cache.sources or len(parts) != 4:
+            self.send_error(404)
+            return
+        # 範囲外のタイル番号はディスクにも配信元にも問い合わせない
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < 1 << z and 0 <= y < 1 << z):
+            self.send_error(400)
+            return
+        try:
+            data, expires = self.cache.get_tile(key, z, x, y)
+        except TileNotFoundError:
+            self.send_error(404)
+            return
+        except _FETCH_ERRORS as e: # 配信元の HTTP エラー・タイムアウト・途中で切れた応答を含む
+            logger.debug("タイル取得失敗 %s/%d/%d/%d: %s", key, z, x, y, e)
+            self.send_error(502)
+            return
+        ext = os.path.splitext(self.cache.sources[key])[1].lower()
+        self.send_response(200)
+        self.send_header("Content-Type", _CONTENT_TYPES.get(ext, "application/octet-stream"))
+        self.send_header("Content-Length", str(len(data)))
+        # クライアントには配信元の有効期限の残りだけキャッシュさせる
+        self.send_header("Cache-Control", f"max-age={max(int(expires - time.time()), 0)}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """アクセスログは標準エラーではなく logging の DEBUG に出す"""
+        logger.debug(format, *args)